@@ -1,4 +1,7 @@
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 import torch
@@ -7,7 +10,39 @@ from new_data_loader import DataLoader
 import statsmodels.api as sm
 
 
-def run_ARIMA(exp_name, pred_len):
+def fit_shard(histories, steps, order=(1, 1, 1)):
+    """Fits one ARIMA per history window, from the default start parameters, and forecasts
+    steps ahead, so that every forecast is independent of how windows are sharded.
+    Returns:
+      Forecasts [n, steps].
+    """
+
+    forecasts = np.zeros((len(histories), steps))
+
+    for i, history in enumerate(histories):
+        forecasts[i] = sm.tsa.ARIMA(history, order=order).fit().forecast(steps=steps)
+
+    return forecasts
+
+
+def parallel_arima_forecasts(histories, steps, num_workers):
+    """Forecasts every history window with a pool of num_workers processes."""
+
+    forecasts = np.zeros((len(histories), steps))
+    shards = np.array_split(np.arange(len(histories)), min(num_workers, len(histories)))
+
+    with ProcessPoolExecutor(max_workers=len(shards)) as executor:
+        results = executor.map(fit_shard,
+                               [histories[shard] for shard in shards],
+                               [steps] * len(shards))
+
+        for shard, shard_forecasts in zip(shards, results):
+            forecasts[shard] = shard_forecasts
+
+    return forecasts
+
+
+def run_ARIMA(exp_name, pred_len, num_workers):
 
     target_col = {"traffic": "values",
                   "electricity": "power_usage",
@@ -25,27 +60,21 @@ def run_ARIMA(exp_name, pred_len):
                              max_test_sample=3840,
                              batch_size=256)
 
-    total_b = len(dataloader_obj.test_loader)
-    _, _, test_y = next(iter(dataloader_obj.test_loader))
+    histories = []
+    test_y_tot = []
+
+    for test_enc, test_dec, test_y in dataloader_obj.test_loader:
 
-    predictions = np.zeros((total_b*256, pred_len))
-    test_y_tot = np.zeros((total_b*256, pred_len))
+        histories.append(torch.cat([test_enc, test_dec], dim=1).squeeze(-1).detach().numpy())
+        test_y_tot.append(test_y[:, -pred_len:].squeeze(-1).detach().numpy())
 
-    j = 0
+    histories = np.concatenate(histories, axis=0).astype(np.float64)
+    test_y_tot = np.concatenate(test_y_tot, axis=0)
 
-    for test_enc, test_dec, test_y in dataloader_obj.test_loader:
+    # the test windows and their lengths differ between horizons, so each horizon is fitted anew
+    forecasts = parallel_arima_forecasts(histories, pred_len, num_workers)
 
-        xes = torch.cat([test_enc, test_dec], dim=1).squeeze(-1).detach().numpy()
-        yes = test_y.squeeze(-1).detach().numpy()
-        for x, y in zip(xes, yes):
-            arima_model = sm.tsa.ARIMA(x, order=(1, 1, 1))
-            arima_results = arima_model.fit()
-            forecasts = arima_results.forecast(steps=pred_len)
-            predictions[j] = forecasts[0]
-            test_y_tot[j] = y[-pred_len:]
-            j += 1
-
-    predictions = torch.from_numpy(predictions.reshape(-1, 1))
+    predictions = torch.from_numpy(forecasts.reshape(-1, 1))
     test_y = torch.from_numpy(test_y_tot.reshape(-1, 1))
 
     mse_loss = F.mse_loss(predictions, test_y).item()
@@ -68,6 +97,12 @@ def run_ARIMA(exp_name, pred_len):
         df.to_csv(error_path)
 
 
-for data_set in ["watershed"]:
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="ARIMA baseline argument parser")
+    parser.add_argument("--exp_name", type=str, default="watershed")
+    parser.add_argument("--num_workers", type=int, default=4)
+    args = parser.parse_args()
+
     for pred_len in [24, 48, 96, 192]:
-        run_ARIMA(data_set, pred_len)
\ No newline at end of file
+        run_ARIMA(args.exp_name, pred_len, args.num_workers)
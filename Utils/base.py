@@ -44,6 +44,10 @@ class GenericDataFormatter(abc.ABC):
     manipulations.
     """
 
+    # Version of the transform_data output, bump it whenever the transformed data
+    # changes so that samples cached from the previous output are not reused
+    version = 1
+
     @abc.abstractmethod
     def set_scalers(self, df):
         """Calibrates scalers using the data_set supplied."""
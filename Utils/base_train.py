@@ -20,16 +20,48 @@ import numpy as np
 from Utils import utils, base
 import pandas as pd
 import random
-from torch.utils.data import DataLoader
-from torch.utils.data import TensorDataset
+from torch.utils.data import Dataset
 
 InputTypes = base.InputTypes
 
 
-def sample_train_val_test(ddf, max_samples, time_steps, num_encoder_steps, pred_len, column_definition, tgt_all=False):
+def valid_window_starts(ids, lo, hi, time_steps):
+    """Returns the start rows of all windows within rows [lo, hi) that belong to a single entity.
+    Args:
+      ids: Entity identifier of every row, with the rows of each entity contiguous
+      lo: First row of the split
+      hi: End row (exclusive) of the split
+      time_steps: Window length
+    """
+
+    split_ids = ids[lo:hi]
+    num_windows = len(split_ids) - time_steps + 1
+    if num_windows <= 0:
+        return np.zeros(0, dtype=np.int64)
+    same_entity = split_ids[:num_windows] == split_ids[time_steps - 1:]
+    return lo + np.flatnonzero(same_entity)
+
+
+def sample_window_starts(data, train_percent, max_samples, time_steps,
+                         column_definition, seed=2436):
+    """Splits the data_set into train, valid and test and samples window start positions from each.
+    Args:
+      data: Sources data_set to sample
+      train_percent: Fraction of the data_set used for training
+      max_samples: Tuple of maximum number of (train, valid/test) samples
+      time_steps: Total number of time steps per window
+      column_definition: Column definition of the experiment
+      seed: Sampling seed
+    Returns:
+      Float32 series array of shape [rows, inputs + target] and a tuple of the
+      sampled (train, valid, test) window start rows.
+    """
+
+    np.random.seed(seed)
+    random.seed(seed)
 
-    id_col = utils.get_single_col_by_input_type(InputTypes.ID, column_definition)
     time_col = utils.get_single_col_by_input_type(InputTypes.TIME, column_definition)
+    id_col = utils.get_single_col_by_input_type(InputTypes.ID, column_definition)
     target_col = utils.get_single_col_by_input_type(InputTypes.TARGET, column_definition)
     enc_input_cols = [
         tup[0]
@@ -37,72 +69,103 @@ def sample_train_val_test(ddf, max_samples, time_steps, num_encoder_steps, pred_
         if tup[2] not in {InputTypes.ID, InputTypes.TIME}
     ]
 
-    valid_sampling_locations = []
-    split_data_map = {}
-
-    for identifier, df in ddf.groupby(id_col):
-        num_entries = len(df)
-        if num_entries >= time_steps:
-            valid_sampling_locations += [
-                (identifier, time_steps + i)
-                for i in range(num_entries - time_steps + 1)
-            ]
-
-            split_data_map[identifier] = df
-
-    if 0 < max_samples < len(valid_sampling_locations):
-        ranges = [
-            valid_sampling_locations[i] for i in np.random.choice(
-                len(valid_sampling_locations), max_samples, replace=False)
-        ]
-    else:
-        print("maximum samples exceeds {}".format(len(valid_sampling_locations)))
-        ranges = [
-            valid_sampling_locations[i] for i in np.random.choice(
-                len(valid_sampling_locations), len(valid_sampling_locations), replace=False)
-        ]
-
-    input_size = len(enc_input_cols)
-    inputs = np.zeros((max_samples, time_steps, input_size))
-    enc_inputs = np.zeros((max_samples, num_encoder_steps, input_size))
-    dec_inputs = np.zeros((max_samples, time_steps - num_encoder_steps - pred_len, input_size))
-    outputs = np.zeros((max_samples, time_steps, 1))
-    time = np.empty((max_samples, time_steps, 1), dtype=object)
-    identifiers = np.empty((max_samples, time_steps, 1), dtype=object)
-
-    for i, tup in enumerate(ranges):
-        if (i + 1 % 1000) == 0:
-            print(i + 1, 'of', max_samples, 'samples done...')
-        identifier, start_idx = tup
-        sliced = split_data_map[identifier].iloc[start_idx -
-                                                 time_steps:start_idx]
-        enc_inputs[i, :, :] = sliced[enc_input_cols].iloc[:num_encoder_steps]
-        dec_inputs[i, :, :] = sliced[enc_input_cols].iloc[num_encoder_steps:-pred_len]
-        inputs[i, :, :] = sliced[enc_input_cols]
-        outputs[i, :, :] = sliced[[target_col]]
-        time[i, :, 0] = sliced[time_col]
-        identifiers[i, :, 0] = sliced[id_col]
-
-    sampled_data = {
-        'inputs': inputs,
-        'enc_inputs': enc_inputs,
-        'dec_inputs': dec_inputs,
-        'outputs': outputs[:, -pred_len:, :],
-        'input_arima': outputs[:, :-pred_len, :],
-        'active_entries': np.ones_like(outputs[:, num_encoder_steps:, :]),
-        'time': time,
-        'identifier': identifiers
-    }
-
-    return sampled_data
+    data.sort_values(by=[id_col, time_col], inplace=True)
+
+    series = data[enc_input_cols + [target_col]].to_numpy(dtype=np.float32)
+    ids = data[id_col].to_numpy()
+
+    train_len = int(len(data) * train_percent)
+    valid_len = int((len(data) - train_len) / 2)
+
+    train_max, valid_max = max_samples
+
+    split_starts = []
+    for (lo, hi), max_split in zip([(0, train_len), (train_len, len(data) - valid_len), (0, len(data))],
+                                   [train_max, valid_max, valid_max]):
+        starts = valid_window_starts(ids, lo, hi, time_steps)
+        if 0 < max_split < len(starts):
+            starts = starts[np.random.choice(len(starts), max_split, replace=False)]
+        else:
+            print("maximum samples exceeds {}".format(len(starts)))
+            starts = starts[np.random.choice(len(starts), len(starts), replace=False)]
+        split_starts.append(starts)
+
+    return series, tuple(split_starts)
+
+
+class WindowDataset(Dataset):
+    """Windows of a [rows, inputs + target] series, sliced lazily from their start rows.
+    The series can be a memory map, in which case only the rows of requested windows are read.
+    Each item is (enc_inputs, dec_inputs, outputs), where the inputs are the first input_size
+    columns and the outputs are the last pred_len steps of the last (target) column.
+    """
+
+    def __init__(self, series, starts, time_steps, num_encoder_steps, pred_len, input_size):
+
+        self.series = series
+        self.starts = starts
+        self.time_steps = time_steps
+        self.num_encoder_steps = num_encoder_steps
+        self.pred_len = pred_len
+        self.input_size = input_size
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+
+        start = self.starts[idx]
+        window = torch.from_numpy(np.array(self.series[start:start + self.time_steps], dtype=np.float32))
+
+        enc_inputs = window[:self.num_encoder_steps, :self.input_size]
+        dec_inputs = window[self.num_encoder_steps:-self.pred_len, :self.input_size]
+        outputs = window[-self.pred_len:, -1:]
+
+        return enc_inputs, dec_inputs, outputs
+
+
+def create_dataloader(dataset, batch_size, drop_last=False, num_workers=0, pin_memory=False, prefetch_factor=2):
+    """Creates the DataLoader used by all training and evaluation entry points.
+    Args:
+      dataset: Dataset to batch
+      batch_size: Batch size
+      drop_last: Whether to drop the last incomplete batch
+      num_workers: Number of worker processes preparing batches, 0 loads in the main process
+      pin_memory: Whether to put batches in pinned memory, enabling non-blocking copies to the GPU
+      prefetch_factor: Number of batches loaded in advance by each worker
+    """
+
+    worker_kwargs = {}
+    if num_workers > 0:
+        # keep the workers alive between epochs and Optuna trials
+        worker_kwargs = {'persistent_workers': True, 'prefetch_factor': prefetch_factor}
+
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, drop_last=drop_last,
+                                       num_workers=num_workers, pin_memory=pin_memory, **worker_kwargs)
+
+
+def get_dataloaders(series, split_starts, time_steps, num_encoder_steps, pred_len, batch_size,
+                    num_workers=0, pin_memory=False):
+    """Wraps the sampled (train, valid, test) windows of the series in DataLoaders."""
+
+    input_size = series.shape[1] - 1
+
+    return tuple(create_dataloader(WindowDataset(series, starts, time_steps,
+                                                 num_encoder_steps, pred_len, input_size),
+                                   batch_size=batch_size, drop_last=True,
+                                   num_workers=num_workers, pin_memory=pin_memory)
+                 for starts in split_starts)
 
 
 def batch_sampled_data(data, train_percent, max_samples, time_steps,
                        num_encoder_steps, pred_len,
-                       column_definition, batch_size, tgt_all=False):
+                       column_definition, batch_size, tgt_all=False, seed=2436,
+                       num_workers=0, pin_memory=False):
     """Samples segments into a compatible format.
     Args:
-      seed:
+      num_workers: Number of DataLoader worker processes
+      pin_memory: Whether the DataLoaders use pinned memory
+      seed: Sampling seed
       column_definition:
       pred_len:
       num_encoder_steps:
@@ -113,42 +176,8 @@ def batch_sampled_data(data, train_percent, max_samples, time_steps,
       Dictionary of batched data_set with the maximum samples specified.
     """
 
-    np.random.seed(2436)
-    random.seed(2436)
-
-    time_col = utils.get_single_col_by_input_type(InputTypes.TIME, column_definition)
-    id_col = utils.get_single_col_by_input_type(InputTypes.ID, column_definition)
-
-    data.sort_values(by=[id_col, time_col], inplace=True)
-
-    train_len = int(len(data) * train_percent)
-    valid_len = int((len(data) - train_len) / 2)
-
-    train = data[:train_len]
-    valid = data[train_len:-valid_len]
-    test = data
-
-    train_max, valid_max = max_samples
-
-    sample_train = sample_train_val_test(train, train_max, time_steps, num_encoder_steps, pred_len, column_definition)
-    sample_valid = sample_train_val_test(valid, valid_max, time_steps, num_encoder_steps, pred_len, column_definition)
-    sample_test = sample_train_val_test(test, valid_max, time_steps, num_encoder_steps, pred_len, column_definition, tgt_all)
-
-    train_data = TensorDataset(torch.FloatTensor(sample_train['enc_inputs']),
-                               torch.FloatTensor(sample_train['dec_inputs']),
-                               torch.FloatTensor(sample_train['outputs']))
-
-    valid_data = TensorDataset(torch.FloatTensor(sample_valid['enc_inputs']),
-                               torch.FloatTensor(sample_valid['dec_inputs']),
-                               torch.FloatTensor(sample_valid['outputs']))
-
-    test_data = TensorDataset(torch.FloatTensor(sample_test['enc_inputs']),
-                              torch.FloatTensor(sample_test['dec_inputs']),
-                              torch.FloatTensor(sample_test['outputs']))
-
-    train_data = torch.utils.data.DataLoader(train_data, batch_size=batch_size, drop_last=True)
-    valid_data = torch.utils.data.DataLoader(valid_data, batch_size=batch_size, drop_last=True)
-    test_data = torch.utils.data.DataLoader(test_data, batch_size=batch_size, drop_last=True)
-
-    return train_data, valid_data, test_data
+    series, split_starts = sample_window_starts(data, train_percent, max_samples,
+                                                time_steps, column_definition, seed)
 
+    return get_dataloaders(series, split_starts, time_steps, num_encoder_steps, pred_len, batch_size,
+                           num_workers, pin_memory)
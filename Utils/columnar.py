@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from Utils.base import DataTypes, InputTypes
+
+_schema_file = 'schema.json'
+
+
+def get_columnar_path(data_csv_path):
+    """Returns the directory holding the columnar copy of a dataset csv."""
+
+    return '{}_columns'.format(os.path.splitext(data_csv_path)[0])
+
+
+def get_dataset_columns(column_definition):
+    """Returns the names of the columns used by an experiment, in definition order."""
+
+    return list(dict.fromkeys(tup[0] for tup in column_definition))
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Returns the sha1 digest of the content of a file."""
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _column_kind(name, column_definition):
+
+    for col, data_type, input_type in column_definition:
+        if col == name:
+            if input_type in {InputTypes.ID, InputTypes.TIME} or data_type != DataTypes.REAL_VALUED:
+                return 'raw'
+            return 'float32'
+    return 'raw'
+
+
+def _source_stat(source_path):
+
+    stat = os.stat(source_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def write_columnar(df, path, column_definition=(), source_path=None):
+    """Writes a data frame as one .npy file per column plus a schema.json.
+    Real-valued input and target columns of column_definition are stored as float32,
+    string columns as int32 codes into a list of categories kept in the schema, and
+    all other columns with their pandas dtype.
+    Args:
+      df: Data frame to write
+      path: Output directory
+      column_definition: Column definition of the experiment, if any
+      source_path: Path of the source csv, whose digest keys caches of the dataset and
+        whose size and modification time tell when the copy is out of date
+    """
+
+    os.makedirs(path, exist_ok=True)
+
+    schema = {'num_rows': len(df), 'columns': [],
+              'source_digest': None if source_path is None else file_digest(source_path),
+              'source_stat': None if source_path is None else _source_stat(source_path)}
+
+    for i, col in enumerate(df.columns):
+        file_name = '{}.npy'.format(i)
+        values = df[col]
+        entry = {'name': str(col), 'file': file_name}
+
+        if _column_kind(col, column_definition) == 'float32':
+            np.save(os.path.join(path, file_name), values.to_numpy(dtype=np.float32))
+            entry['kind'] = 'float32'
+
+        elif values.dtype.kind in 'biuf':
+            np.save(os.path.join(path, file_name), values.to_numpy())
+            entry['kind'] = 'numeric'
+
+        else:
+            codes, categories = pd.factorize(values, use_na_sentinel=True)
+            np.save(os.path.join(path, file_name), codes.astype(np.int32))
+            entry['kind'] = 'string'
+            entry['categories'] = [str(c) for c in categories]
+
+        schema['columns'].append(entry)
+
+    with open(os.path.join(path, _schema_file), 'w') as f:
+        json.dump(schema, f)
+
+
+def _read_schema(path):
+
+    with open(os.path.join(path, _schema_file)) as f:
+        return json.load(f)
+
+
+def _current_schema(data_csv_path):
+
+    # schema of the columnar copy of a csv, None if there is no copy or the csv changed since
+    schema_path = os.path.join(get_columnar_path(data_csv_path), _schema_file)
+    if not os.path.exists(schema_path):
+        return None
+    schema = _read_schema(get_columnar_path(data_csv_path))
+    if os.path.exists(data_csv_path) and schema.get('source_stat') != _source_stat(data_csv_path):
+        print('Ignoring out of date columnar copy of {}'.format(data_csv_path))
+        return None
+    return schema
+
+
+def read_columnar(path, columns=None):
+    """Reads the given columns (all if None) of a dataset written by write_columnar."""
+
+    schema = _read_schema(path)
+    entries = {entry['name']: entry for entry in schema['columns']}
+    columns = list(entries) if columns is None else columns
+
+    data = {}
+    for col in columns:
+        entry = entries[col]
+        values = np.load(os.path.join(path, entry['file']))
+        if entry['kind'] == 'string':
+            categories = np.array(entry['categories'] + [np.nan], dtype=object)
+            values = categories[values]
+        data[col] = values
+
+    return pd.DataFrame(data, columns=columns)
+
+
+def read_dataset(data_csv_path, columns=None):
+    """Reads a dataset, from its columnar copy if data_loader.py wrote one from the current
+    csv, else from the csv.
+    Args:
+      data_csv_path: Path of the dataset csv
+      columns: Names of the columns to read, all if None
+    Returns:
+      Data frame with the requested columns.
+    """
+
+    if _current_schema(data_csv_path) is not None:
+        return read_columnar(get_columnar_path(data_csv_path), columns)
+
+    return pd.read_csv(data_csv_path, dtype={'date': str}, usecols=columns)
+
+
+def dataset_digest(data_csv_path):
+    """Returns the digest of the dataset read_dataset reads, recorded in its columnar schema or
+    hashed from the csv. The columnar copy stores real values as float32, so its digest is
+    marked with that storage type to keep it apart from the csv data."""
+
+    schema = _current_schema(data_csv_path)
+    if schema is not None and schema['source_digest'] is not None:
+        return '{}:float32'.format(schema['source_digest'])
+
+    return file_digest(data_csv_path)
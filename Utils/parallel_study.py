@@ -0,0 +1,158 @@
+import multiprocessing
+import os
+
+import optuna
+import torch
+from optuna.study import MaxTrialsCallback
+from optuna.trial import TrialState
+
+try:
+    from optuna.storages.journal import JournalFileBackend
+except ImportError:
+    # optuna < 4.0
+    from optuna.storages import JournalFileStorage as JournalFileBackend
+
+
+def get_journal_storage(storage_path):
+    """Returns an optuna storage kept in a local journal file, safe to share between processes."""
+
+    return optuna.storages.JournalStorage(JournalFileBackend(storage_path))
+
+
+def get_pruner(name, max_epochs):
+    """Returns the optuna pruner called name, stopping trials on their per-epoch validation loss.
+    Args:
+      name: One of 'median', 'hyperband', 'successive_halving' or 'none'
+      max_epochs: Maximum number of epochs of a trial
+    """
+
+    pruners = {
+        "median": lambda: optuna.pruners.MedianPruner(n_startup_trials=2, n_warmup_steps=2),
+        "hyperband": lambda: optuna.pruners.HyperbandPruner(min_resource=1, max_resource=max_epochs),
+        "successive_halving": lambda: optuna.pruners.SuccessiveHalvingPruner(min_resource=1),
+        "none": lambda: optuna.pruners.NopPruner(),
+    }
+    if name not in pruners:
+        raise ValueError("Unrecognised pruner {}, expected one of {}".format(name, list(pruners)))
+    return pruners[name]()
+
+
+def get_trial_checkpoint_path(model_path, model_name, trial_number):
+    """Returns the checkpoint path owned by a single trial, so that concurrent trials never write the same file."""
+
+    return os.path.join(model_path, "{}_trial{}".format(model_name, trial_number))
+
+
+def is_duplicate_trial(trial):
+    """Returns True if an earlier complete, pruned or running trial of the study was given the same
+    parameters. Only earlier trials count, so that two concurrent trials never prune each other."""
+
+    states = (TrialState.COMPLETE, TrialState.PRUNED, TrialState.RUNNING)
+    for other in trial.study.get_trials(deepcopy=False, states=states):
+        if other.number < trial.number and other.params == trial.params:
+            return True
+    return False
+
+
+def _optimize_worker(objective, study_name, storage_path, n_trials, worker_id, n_jobs,
+                     sampler_seed, pruner):
+
+    if n_jobs > 1:
+        # split the cores between trials instead of letting each process use all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_jobs))
+
+    study = optuna.load_study(study_name=study_name,
+                              storage=get_journal_storage(storage_path),
+                              sampler=optuna.samplers.TPESampler(
+                                  seed=None if sampler_seed is None else sampler_seed + worker_id),
+                              pruner=pruner)
+    study.optimize(objective, callbacks=[MaxTrialsCallback(n_trials, states=None)])
+
+
+def run_parallel_study(objective, study_name, storage_path, n_trials, n_jobs,
+                       sampler_seed=None, pruner=None):
+    """Runs an optuna study with trials spread over n_jobs processes.
+    Processes share the study through a journal file at storage_path and only exchange
+    trial parameters and values through it, so every trial holds its own model state.
+    The study is created afresh, replacing any journal left by a previous run.
+    Args:
+      objective: Objective function, called in the worker processes
+      study_name: Name of the study
+      storage_path: Path of the journal file
+      n_trials: Total number of trials, over all processes
+      n_jobs: Number of worker processes, trials run in this process if 1
+      sampler_seed: Seed of the TPE sampler, offset by the index of each worker
+      pruner: Pruner used by every worker, optuna's default if None
+    Returns:
+      The finished study.
+    """
+
+    if os.path.exists(storage_path):
+        os.remove(storage_path)
+
+    optuna.create_study(study_name=study_name,
+                        storage=get_journal_storage(storage_path),
+                        direction="minimize")
+
+    if n_jobs <= 1:
+        _optimize_worker(objective, study_name, storage_path, n_trials, 0, 1, sampler_seed, pruner)
+
+    else:
+        if torch.cuda.is_initialized():
+            raise RuntimeError("CUDA is initialised in the process forking the optuna workers, "
+                               "run CUDA work between studies with run_cuda_work")
+
+        # fork so that workers inherit the loaded data instead of pickling it
+        ctx = multiprocessing.get_context("fork")
+        workers = [ctx.Process(target=_optimize_worker,
+                               args=(objective, study_name, storage_path, n_trials, i, n_jobs,
+                                     sampler_seed, pruner))
+                   for i in range(n_jobs)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        failed = [worker.exitcode for worker in workers if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError("{} optuna worker(s) exited with codes {}".format(len(failed), failed))
+
+    return optuna.load_study(study_name=study_name, storage=get_journal_storage(storage_path))
+
+
+def run_cuda_work(fn, n_jobs):
+    """Runs fn, which may use CUDA, in a forked process when studies run n_jobs > 1 workers.
+    CUDA cannot be re-initialised in a forked process, so the process that forks the workers
+    of every study must never initialise it itself.
+    """
+
+    if n_jobs <= 1:
+        fn()
+        return
+
+    process = multiprocessing.get_context("fork").Process(target=fn)
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("{} exited with code {}".format(fn.__name__, process.exitcode))
+
+
+def resolve_best_checkpoint(study, model_path, model_name):
+    """Keeps the checkpoint of the best trial under model_name and removes those of the other trials.
+    Returns:
+      Path of the best checkpoint.
+    """
+
+    best_path = os.path.join(model_path, model_name)
+    best_number = study.best_trial.number
+
+    for trial in study.get_trials(deepcopy=False):
+        trial_path = get_trial_checkpoint_path(model_path, model_name, trial.number)
+        if not os.path.exists(trial_path):
+            continue
+        if trial.number == best_number:
+            os.replace(trial_path, best_path)
+        else:
+            os.remove(trial_path)
+
+    return best_path
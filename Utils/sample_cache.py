@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from Utils.base_train import sample_window_starts, get_dataloaders
+from Utils.columnar import dataset_digest, get_dataset_columns, read_dataset
+
+_splits = ('train', 'valid', 'test')
+
+# sampled experiments are cached in the repository, whatever the working directory
+default_cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sampled_data')
+
+
+def get_cache_key(data_csv_path, formatter, train_percent, max_samples, time_steps,
+                  num_encoder_steps, pred_len, seed):
+    """Content-addressed key of a sampled experiment.
+    Args:
+      data_csv_path: Path of the dataset csv file
+      formatter: Data formatter used to transform the dataset
+      train_percent: Fraction of the data_set used for training
+      max_samples: Tuple of maximum number of (train, valid/test) samples
+      time_steps: Total number of time steps per window
+      num_encoder_steps: Number of encoder time steps
+      pred_len: Prediction length
+      seed: Sampling seed
+    Returns:
+      Hex digest identifying the sampled arrays.
+    """
+
+    config = {
+        'data': dataset_digest(data_csv_path),
+        'formatter': '{}.{}'.format(type(formatter).__module__, type(formatter).__name__),
+        'formatter_version': formatter.version,
+        'train_percent': train_percent,
+        'max_samples': list(max_samples),
+        'total_time_steps': time_steps,
+        'num_encoder_steps': num_encoder_steps,
+        'pred_len': pred_len,
+        'seed': seed,
+    }
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def _load_samples(path):
+
+    # the series stays on disk and is paged in window by window by WindowDataset
+    series = np.load(os.path.join(path, 'series.npy'), mmap_mode='r')
+    split_starts = tuple(np.load(os.path.join(path, '{}_starts.npy'.format(split)))
+                         for split in _splits)
+    return series, split_starts
+
+
+def _save_samples(path, series, split_starts):
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'series.npy'), series)
+    for split, starts in zip(_splits, split_starts):
+        np.save(os.path.join(tmp_path, '{}_starts.npy'.format(split)), starts)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished writing the same key first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def cached_batch_sampled_data(data_csv_path, formatter, train_percent, max_samples, time_steps,
+                              num_encoder_steps, pred_len, column_definition, batch_size,
+                              seed=2436, cache_dir=default_cache_dir, num_workers=0, pin_memory=False):
+    """Same as batch_sampled_data, but reads the dataset of data_csv_path and caches the
+    transformed float32 series and the sampled window starts as .npy files in cache_dir.
+    On a cache hit the csv is neither parsed nor transformed, so formatter scalers are
+    left unset, and the series is memory-mapped instead of loaded.
+    Returns:
+      Tuple of (train, valid, test) DataLoaders.
+    """
+
+    key = get_cache_key(data_csv_path, formatter, train_percent, max_samples, time_steps,
+                        num_encoder_steps, pred_len, seed)
+    path = os.path.join(cache_dir, key)
+
+    if os.path.isdir(path):
+        print('Loading sampled data from {}'.format(path))
+        series, split_starts = _load_samples(path)
+
+    else:
+        data = read_dataset(data_csv_path, columns=get_dataset_columns(column_definition))
+        data = formatter.transform_data(data)
+        series, split_starts = sample_window_starts(data, train_percent, max_samples, time_steps,
+                                                    column_definition, seed=seed)
+        os.makedirs(cache_dir, exist_ok=True)
+        _save_samples(path, series, split_starts)
+
+    return get_dataloaders(series, split_starts, time_steps, num_encoder_steps, pred_len, batch_size,
+                           num_workers, pin_memory)
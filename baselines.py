@@ -7,7 +7,6 @@ import numpy as np
 import optuna
 import torch
 from forecasting_models.DLinear import DLinear
-from optuna.samplers import TPESampler
 from optuna.trial import TrialState
 from forecasting_models import DeepAR
 from forecasting_models import NBeats
@@ -16,6 +15,8 @@ from torch import nn
 from torch.optim import Adam
 
 from modules.opt_model import NoamOpt
+from Utils.parallel_study import run_parallel_study, get_trial_checkpoint_path, \
+    is_duplicate_trial, resolve_best_checkpoint, get_pruner, run_cuda_work
 from new_data_loader import DataLoader
 
 
@@ -68,9 +69,10 @@ class Baselines:
                                          pred_len=pred_len,
                                          max_train_sample=32000,
                                          max_test_sample=3840,
-                                         batch_size=256)
+                                         batch_size=256,
+                                         num_workers=args.num_workers,
+                                         pin_memory=self.device.type == "cuda")
 
-        self.param_history = []
         self.model_path = "models_{}_{}".format(args.exp_name, pred_len)
         self.model_name = "{}_{}_{}_{}".format(args.model_name,
                                             self.exp_name,
@@ -78,7 +80,7 @@ class Baselines:
                                             pred_len)
         self.num_epochs = args.num_epochs
         self.run_optuna(args)
-        self.evaluate()
+        run_cuda_work(self.evaluate, args.n_jobs)
 
     def get_deep_ar_model(self, d_model, n_layers):
 
@@ -105,10 +107,13 @@ class Baselines:
 
     def run_optuna(self, args):
 
-        study = optuna.create_study(study_name=args.model_name,
-                                    direction="minimize", pruner=optuna.pruners.HyperbandPruner(),
-                                    sampler=TPESampler(seed=1234))
-        study.optimize(self.objective, n_trials=args.n_trials, n_jobs=4)
+        if not os.path.exists(self.model_path):
+            os.makedirs(self.model_path)
+
+        study = run_parallel_study(self.objective, self.model_name,
+                                   os.path.join(self.model_path, "{}_optuna.log".format(self.model_name)),
+                                   args.n_trials, args.n_jobs,
+                                   sampler_seed=1234, pruner=get_pruner(args.pruner, self.num_epochs))
 
         pruned_trials = study.get_trials(deepcopy=False, states=[TrialState.PRUNED])
         complete_trials = study.get_trials(deepcopy=False, states=[TrialState.COMPLETE])
@@ -127,6 +132,21 @@ class Baselines:
         for key, value in trial.params.items():
             print("    {}: {}".format(key, value))
 
+        # trials ran in other processes, evaluate rebuilds the best one from its checkpoint
+        self.best_path = resolve_best_checkpoint(study, self.model_path, "{}_{}".format(self.model_name, self.seed))
+        self.best_params = trial.params
+        self.best_val = trial.value
+
+    def get_model(self, d_model, stack_size):
+
+        if self.model_id == "DeepAR":
+            return self.get_deep_ar_model(d_model, stack_size)
+
+        elif self.model_id == "NBeats":
+            return self.get_nbeats_model(d_model, n_layers=1)
+        else:
+            return self.get_dlinear_model()
+
     def objective(self, trial):
 
         if not os.path.exists(self.model_path):
@@ -138,21 +158,16 @@ class Baselines:
         w_steps = trial.suggest_categorical("w_steps", [4000])
         stack_size = trial.suggest_categorical("stack_size", [1, 2] if self.model_id != "NBeats" else [1])
 
-        if [d_model, stack_size, w_steps] in self.param_history:
+        if is_duplicate_trial(trial):
             raise optuna.exceptions.TrialPruned()
-        self.param_history.append([d_model, stack_size, w_steps])
-
-        if self.model_id == "DeepAR":
-            model = self.get_deep_ar_model(d_model, stack_size)
 
-        elif self.model_id == "NBeats":
-            model = self.get_nbeats_model(d_model, n_layers=1)
-        else:
-            model = self.get_dlinear_model()
+        model = self.get_model(d_model, stack_size)
 
         optimizer = NoamOpt(Adam(model.parameters(), lr=0, betas=(0.9, 0.98), eps=1e-9), 2, d_model, w_steps)
 
         val_loss = 1e10
+        epochs_no_improve = 0
+        patience = self.dataloader_obj.formatter.get_experiment_params()['early_stopping_patience']
 
         print("Start Training...")
 
@@ -163,9 +178,9 @@ class Baselines:
 
             for x_enc, x_dec, y in self.dataloader_obj.train_loader:
 
-                x_enc = x_enc.to(self.device)
-                x_dec = x_dec.to(self.device)
-                y = y.to(self.device)
+                x_enc = x_enc.to(self.device, non_blocking=True)
+                x_dec = x_dec.to(self.device, non_blocking=True)
+                y = y.to(self.device, non_blocking=True)
 
                 x = torch.cat([x_enc, x_dec], dim=1)
 
@@ -190,9 +205,9 @@ class Baselines:
             test_loss = 0
 
             for valid_x_enc, valid_x_dec, valid_y in self.dataloader_obj.valid_loader:
-                valid_x_enc = valid_x_enc.to(self.device)
-                valid_x_dec = valid_x_dec.to(self.device)
-                valid_y = valid_y.to(self.device)
+                valid_x_enc = valid_x_enc.to(self.device, non_blocking=True)
+                valid_x_dec = valid_x_dec.to(self.device, non_blocking=True)
+                valid_y = valid_y.to(self.device, non_blocking=True)
                 valid_x = torch.cat([valid_x_enc, valid_x_dec], dim=1)
                 if isinstance(model, DeepAR.Net):
                     hidden = model.init_hidden(valid_x.shape[1])
@@ -214,16 +229,27 @@ class Baselines:
 
             if test_loss < val_loss:
                 val_loss = test_loss
-                if val_loss < self.best_val:
-                    self.best_val = val_loss
-                    self.best_model = model
-                    torch.save({'model_state_dict': self.best_model.state_dict()},
-                               os.path.join(self.model_path, "{}_{}".format(self.model_name, self.seed)))
+                epochs_no_improve = 0
+                torch.save({'model_state_dict': model.state_dict()},
+                           get_trial_checkpoint_path(self.model_path, "{}_{}".format(self.model_name, self.seed),
+                                                     trial.number))
+            else:
+                epochs_no_improve += 1
+
+            trial.report(test_loss, epoch)
+            if trial.should_prune():
+                raise optuna.exceptions.TrialPruned()
+
+            if epochs_no_improve >= patience:
+                print("Early stopping at epoch: {}".format(epoch))
+                break
 
         return val_loss
 
     def evaluate(self):
 
+        self.best_model = self.get_model(self.best_params["d_model"], self.best_params["stack_size"])
+        self.best_model.load_state_dict(torch.load(self.best_path, map_location=self.device)['model_state_dict'])
         self.best_model.eval()
         total_b = len(self.dataloader_obj.test_loader)
         _, _, test_y = next(iter(self.dataloader_obj.test_loader))
@@ -235,8 +261,8 @@ class Baselines:
 
         for x_enc, x_dec, y in self.dataloader_obj.test_loader:
 
-            x = torch.cat([x_enc, x_dec], dim=1).to(self.device)
-            y = y.to(self.device)
+            x = torch.cat([x_enc, x_dec], dim=1).to(self.device, non_blocking=True)
+            y = y.to(self.device, non_blocking=True)
 
             if isinstance(self.best_model, DeepAR.Net):
 
@@ -286,8 +312,12 @@ parser.add_argument("--exp_name", type=str, default='traffic')
 parser.add_argument("--model_name", type=str, default='DeepAR')
 parser.add_argument("--cuda", type=str, default="cuda:0")
 parser.add_argument("--n_trials", type=int, default=50)
+parser.add_argument("--n_jobs", type=int, default=4, help="Optuna trials run in parallel processes")
+parser.add_argument("--pruner", type=str, default="hyperband",
+                    choices=["median", "hyperband", "successive_halving", "none"])
 parser.add_argument("--num_epochs", type=int, default=1)
 parser.add_argument("--seed", type=int, default=2021)
+parser.add_argument("--num_workers", type=int, default=5)
 args = parser.parse_args()
 
 random.seed(2021)
@@ -15,6 +15,7 @@
 
 # Lint as: python3
 
+import numpy as np
 import pandas as pd
 import sklearn.preprocessing
 
@@ -43,10 +44,14 @@ class ElectricityFormatter(GenericDataFormatter):
       ('categorical_id', DataTypes.CATEGORICAL, InputTypes.STATIC_INPUT),
     ]
 
+    # 2: categorical inputs are encoded from the rows of the transformed frame
+    version = 2
+
     def __init__(self, pred_len):
         """Initialises formatter."""
 
         self.identifiers = None
+        self._scaler_ids = None
         self._real_scalers = None
         self._cat_scalers = None
         self._target_scaler = None
@@ -90,23 +95,32 @@ class ElectricityFormatter(GenericDataFormatter):
             DataTypes.REAL_VALUED, column_definitions,
             {InputTypes.ID, InputTypes.TIME})
 
-        # Initialise scaler caches
-        self._real_scalers = {}
-        self._target_scaler = {}
-        identifiers = []
-        for identifier, sliced in df.groupby(id_column):
-
-          if len(sliced) >= self._time_steps:
-
-            data = sliced[real_inputs].values
-            targets = sliced[[target_column]].values
-            self._real_scalers[identifier] \
-          = sklearn.preprocessing.StandardScaler().fit(data)
-
-            self._target_scaler[identifier] \
-          = sklearn.preprocessing.StandardScaler().fit(targets)
-
-          identifiers.append(identifier)
+        # Per-entity mean and std of every real input and of the target, computed in one
+        # groupby pass and stored as [entities, columns] arrays indexed by self._scaler_ids.
+        # Only trajectories long enough to be sampled get scalers.
+        ids = df[id_column].to_numpy()
+        # identifiers lists every entity, including those too short to get scalers
+        identifiers = sorted(pd.unique(ids))
+
+        lengths = pd.Series(ids).value_counts()
+        long_enough = df[id_column].map(lengths).to_numpy() >= self._time_steps
+
+        stats_columns = list(range(len(real_inputs) + 1))
+        stats_df = pd.DataFrame(np.column_stack([df[real_inputs].to_numpy(dtype=np.float64),
+                                                 df[target_column].to_numpy(dtype=np.float64)])[long_enough],
+                                columns=stats_columns)
+        grouped = stats_df.groupby(ids[long_enough], sort=True)
+        means = grouped.mean()
+        stds = grouped.std(ddof=0)
+
+        means_values = means.to_numpy()
+        # same as sklearn's StandardScaler, constant columns are left unscaled
+        stds_values = stds.to_numpy(copy=True)
+        stds_values[stds_values == 0.0] = 1.0
+
+        self._scaler_ids = means.index
+        self._real_scalers = (means_values[:, :-1], stds_values[:, :-1])
+        self._target_scaler = (means_values[:, -1], stds_values[:, -1])
 
         # Format categorical scalers
         categorical_inputs = utils.extract_cols_from_data_type(
@@ -117,7 +131,7 @@ class ElectricityFormatter(GenericDataFormatter):
         num_classes = []
         for col in categorical_inputs:
             # Set all to str so that we don't have mixed integer/string columns
-          srs = df[col].apply(str)
+          srs = df[col].astype(str)
           categorical_scalers[col] = sklearn.preprocessing.LabelEncoder()
           categorical_scalers[col].fit(srs.values)
           num_classes.append(srs.nunique())
@@ -152,23 +166,23 @@ class ElectricityFormatter(GenericDataFormatter):
             DataTypes.CATEGORICAL, column_definitions,
             {InputTypes.ID, InputTypes.TIME})
 
-        # Transform real inputs per entity
-        df_list = []
-        for identifier, sliced in df.groupby(id_col):
-            # Filter out any trajectories that are too short
-            if len(sliced) >= self._time_steps:
-                sliced_copy = sliced.copy()
-                sliced_copy[real_inputs] = self._real_scalers[identifier].transform(
-                    sliced_copy[real_inputs].values)
-                df_list.append(sliced_copy)
+        # Filter out any trajectories that are too short, and order rows by entity
+        codes = self._scaler_ids.get_indexer(df[id_col])
+        rows = np.flatnonzero(codes >= 0)
+        rows = rows[np.argsort(codes[rows], kind='stable')]
+        codes = codes[rows]
+
+        output = df.iloc[rows].copy()
 
-        output = pd.concat(df_list, axis=0)
+        # Transform real inputs per entity
+        means, stds = self._real_scalers
+        output[real_inputs] = (output[real_inputs].to_numpy(dtype=np.float64) - means[codes]) / stds[codes]
 
         # Format categorical inputs
         for col in categorical_inputs:
 
-            string_df = df[col].apply(str)
-            output[col] = self._cat_scalers[col].transform(string_df[:len(output)])
+            string_df = output[col].astype(str)
+            output[col] = self._cat_scalers[col].transform(string_df)
 
         return output
 
@@ -183,30 +197,19 @@ class ElectricityFormatter(GenericDataFormatter):
         if self._target_scaler is None:
             raise ValueError('Scalers have not been set!')
 
-        column_names = predictions.columns
+        if len(predictions) == 0:
+            return None
 
-        df_list = []
-        for identifier, sliced in predictions.groupby('identifier'):
-            sliced_copy = sliced.copy()
-            target_scaler = self._target_scaler[identifier]
+        codes = self._scaler_ids.get_indexer(predictions['identifier'])
+        if (codes < 0).any():
+            raise ValueError('Predictions contain identifiers without scalers!')
 
-            for col in column_names:
-                if col not in {'identifier'}:
-                    try:
-                        sliced_copy[col] = target_scaler.inverse_transform(sliced_copy[col])
-                    except ValueError:
-                        if len(sliced_copy[col]) == 1:
-                            pred = sliced_copy[col].to_numpy().reshape(1, -1)
-                        else:
-                            pred = sliced_copy[col].to_numpy().reshape(-1, 1)
+        means, stds = self._target_scaler
 
-                        sliced_copy[col] = target_scaler.inverse_transform(pred)
-
-            df_list.append(sliced_copy)
-        if len(df_list) == 0:
-            output = None
-        else:
-            output = pd.concat(df_list, axis=0)
+        output = predictions.copy()
+        for col in predictions.columns:
+            if col not in {'identifier'}:
+                output[col] = predictions[col].to_numpy(dtype=np.float64) * stds[codes] + means[codes]
 
         return output
 
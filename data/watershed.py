@@ -17,7 +17,6 @@
 
 from Utils.base import DataTypes, InputTypes
 from data.electricity import ElectricityFormatter
-import pandas as pd
 
 DataFormatter = ElectricityFormatter
 
@@ -75,25 +74,13 @@ class WatershedFormatter(DataFormatter):
 
         column_names = covariates.columns
 
-        df_list = []
-        for identifier, sliced in covariates.groupby('identifier'):
-            sliced_copy = sliced.copy()
-            real_scalers = self._real_scalers[identifier]
-
-            for i in range(48):
-                df_inner_list = []
-                inds = []
-                for j in range(10):
-                    ind = 48*j + i
-                    inds.append(ind)
-                    col = column_names[ind]
-                    df_inner_list.append(sliced_copy[col])
-                sliced_df = pd.concat(df_inner_list, axis=1)
-                sliced_copy[column_names[inds]] = real_scalers.inverse_transform(sliced_df)
-
-            df_list.append(sliced_copy)
-
-        output = pd.concat(df_list, axis=0)
+        codes = self._scaler_ids.get_indexer(covariates['identifier'])
+        means, stds = self._real_scalers
+
+        output = covariates.copy()
+        for i in range(48):
+            inds = [48*j + i for j in range(10)]
+            output[column_names[inds]] = covariates[column_names[inds]].to_numpy() * stds[codes] + means[codes]
 
         return output
 
@@ -30,6 +30,7 @@ from tqdm import tqdm
 
 
 from data import air_quality, electricity, traffic, watershed, solar, exchange
+from Utils.columnar import get_columnar_path, write_columnar
 
 
 class ExperimentConfig(object):
@@ -916,6 +917,19 @@ def main(expt_name, force_download, output_folder):
 
     print('Download completed.')
 
+    # Columnar copy of the processed csv, read with column projection by the training scripts
+    data_csv_path = "{}.csv".format(expt_name)
+    if os.path.exists(data_csv_path):
+        try:
+            column_definition = expt_config.make_data_formatter().get_column_definition()
+        except KeyError:
+            column_definition = ()
+        print('Writing columnar copy to {}'.format(get_columnar_path(data_csv_path)))
+        write_columnar(pd.read_csv(data_csv_path, dtype={'date': str}),
+                       get_columnar_path(data_csv_path),
+                       column_definition,
+                       source_path=data_csv_path)
+
 
 if __name__ == '__main__':
     def get_args():
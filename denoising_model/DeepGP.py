@@ -7,8 +7,10 @@ from gpytorch.distributions import MultivariateNormal
 from gpytorch.kernels import ScaleKernel, RBFKernel, MaternKernel
 from gpytorch.likelihoods import GaussianLikelihood
 from gpytorch.means import ConstantMean, LinearMean
+from gpytorch.mlls import DeepApproximateMLL, VariationalELBO
 from gpytorch.models.deep_gps import DeepGPLayer, DeepGP
 from gpytorch.variational import VariationalStrategy, MeanFieldVariationalDistribution
+from linear_operator.utils.cholesky import psd_safe_cholesky
 
 
 class ToyDeepGPHiddenLayer(DeepGPLayer):
@@ -86,14 +88,57 @@ class DeepGPp(DeepGP):
 
         self.hidden_layer = hidden_layer
         self.likelihood = GaussianLikelihood()
+        # (parameter versions, L^{-T} m) of the predictive mean, only used in eval mode
+        self._mean_weights = None
+
+    def train(self, mode=True):
+        self._mean_weights = None
+        return super().train(mode)
 
     def forward(self, inputs):
         dist = self.hidden_layer(inputs)
         return dist
 
-    def predict(self, x):
+    def predictive_mean_weights(self):
+        """
+        Returns L^{-T} m, with L the Cholesky factor of the inducing point covariance K_zz and m
+        the whitened variational mean, so that the predictive mean at x is mean(x) + K_xz L^{-T} m.
+        Cached until train() is called or a parameter is updated or moved.
+        """
+        version = tuple((p.data_ptr(), p._version) for p in self.parameters())
+        if self._mean_weights is None or self._mean_weights[0] != version:
+            strategy = self.hidden_layer.variational_strategy
+            with torch.no_grad():
+                induc_induc_covar = self.hidden_layer.covar_module(strategy.inducing_points)
+                L = psd_safe_cholesky(induc_induc_covar.add_jitter(strategy.jitter_val).to_dense())
+                m = strategy.variational_distribution.mean.unsqueeze(-1)
+                weights = torch.linalg.solve_triangular(L.transpose(-1, -2), m, upper=True)
+            self._mean_weights = (version, weights)
+        return self._mean_weights[1]
+
+    def predict(self, x, sample=False):
+
+        strategy = self.hidden_layer.variational_strategy
+
+        if sample:
+            # a posterior draw of the GP instead of its mean
+            dist = self(x)
+            return dist.rsample(), dist
+
+        # at inference only the predictive mean is used, which needs a single K_xz product
+        if not self.training and strategy.updated_strategy.item():
+            weights = self.predictive_mean_weights()
+            x_flat = x.reshape(-1, x.shape[-1])
+            induc_data_covar = self.hidden_layer.covar_module(x_flat, strategy.inducing_points).to_dense()
+            mean = self.hidden_layer.mean_module(x_flat) + (induc_data_covar @ weights).squeeze(-1)
+            mean = mean.reshape(x.shape[:-1])
+            return mean.expand(gpytorch.settings.num_likelihood_samples.value(), *mean.shape), None
 
         dist = self(x)
         preds = self.likelihood(dist)
 
-        return preds.mean, dist
\ No newline at end of file
+        return preds.mean, dist
+
+    def mll_loss(self, dist, target, num_data):
+        mll = DeepApproximateMLL(VariationalELBO(self.likelihood, self, num_data))
+        return -mll(dist, target)
\ No newline at end of file
@@ -0,0 +1,133 @@
+import math
+import random
+
+import gpytorch
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from gpytorch.distributions import MultivariateNormal
+from gpytorch.kernels import ScaleKernel, RBFKernel
+from gpytorch.likelihoods import GaussianLikelihood
+from gpytorch.means import ConstantMean, LinearMean
+from gpytorch.mlls import VariationalELBO
+from gpytorch.models import ApproximateGP
+from gpytorch.variational import CholeskyVariationalDistribution, GridInterpolationVariationalStrategy
+from linear_operator.operators import DiagLinearOperator
+
+
+class GridGP(ApproximateGP):
+    """
+    GP over a learned scalar projection of each token embedding, squashed to [0, 1], with a
+    KISS-GP (SKI) variational strategy interpolating from grid_size inducing points on a
+    regular grid, so the cost is linear in the number of tokens. SKI needs low-dimensional
+    inputs, so the noise depends on the embeddings only through that one projection.
+    """
+    def __init__(self, num_hidden_dims, seed, grid_size=128):
+
+        np.random.seed(seed)
+        random.seed(seed)
+        torch.manual_seed(seed)
+
+        variational_distribution = CholeskyVariationalDistribution(grid_size)
+        variational_strategy = GridInterpolationVariationalStrategy(
+            self,
+            grid_size=grid_size,
+            grid_bounds=[(0, 1)],
+            variational_distribution=variational_distribution
+        )
+
+        super(GridGP, self).__init__(variational_strategy)
+
+        self.mean_module = ConstantMean()
+        self.covar_module = ScaleKernel(RBFKernel())
+        self.likelihood = GaussianLikelihood()
+        self.projection = nn.Linear(num_hidden_dims, 1)
+
+    def forward(self, z):
+        mean_z = self.mean_module(z)
+        covar_z = self.covar_module(z)
+        return MultivariateNormal(mean_z, covar_z)
+
+    def predict(self, x, sample=False):
+
+        num_samples = gpytorch.settings.num_likelihood_samples.value()
+
+        # one GP per sequence, over the projected tokens within the grid bounds
+        dist = self(torch.sigmoid(self.projection(x)))
+        if sample:
+            return dist.rsample(torch.Size([num_samples])), dist
+
+        preds = self.likelihood(dist)
+        mean = preds.mean.expand(num_samples, *preds.mean.shape)
+
+        return mean, dist
+
+    def mll_loss(self, dist, target, num_data):
+        return -VariationalELBO(self.likelihood, self, num_data)(dist, target)
+
+
+class RFFGP(nn.Module):
+    """
+    GP over the token embeddings approximated with num_features random Fourier features
+    of an ARD RBF kernel, f(x) = phi(x) w with a mean-field Gaussian posterior over w,
+    so the cost is linear in the number of tokens.
+    """
+    def __init__(self, num_hidden_dims, seed, num_features=256):
+
+        super(RFFGP, self).__init__()
+
+        np.random.seed(seed)
+        random.seed(seed)
+        torch.manual_seed(seed)
+
+        self.num_features = num_features
+        self.register_buffer('omega', torch.randn(num_hidden_dims, num_features))
+        self.register_buffer('phase', 2 * math.pi * torch.rand(num_features))
+
+        self.raw_lengthscale = nn.Parameter(torch.zeros(num_hidden_dims))
+        self.raw_outputscale = nn.Parameter(torch.zeros(1))
+        # q(w) starts at the N(0, I) prior
+        self.variational_mean = nn.Parameter(torch.zeros(num_features))
+        self.raw_variational_std = nn.Parameter(torch.full((num_features,), math.log(math.e - 1)))
+
+        self.mean_module = LinearMean(num_hidden_dims)
+        self.likelihood = GaussianLikelihood()
+
+    def features(self, x):
+        lengthscale = F.softplus(self.raw_lengthscale)
+        outputscale = F.softplus(self.raw_outputscale)
+        return torch.sqrt(2 * outputscale / self.num_features) * \
+            torch.cos((x / lengthscale) @ self.omega + self.phase)
+
+    def forward(self, x):
+        phi = self.features(x)
+        mean_x = self.mean_module(x) + phi @ self.variational_mean
+        var_x = (phi.square() @ F.softplus(self.raw_variational_std).square()).clamp_min(1e-6)
+        return MultivariateNormal(mean_x, DiagLinearOperator(var_x))
+
+    def kl_divergence(self):
+        var = F.softplus(self.raw_variational_std).square()
+        return 0.5 * (var + self.variational_mean.square() - 1 - var.log()).sum()
+
+    def predict(self, x, sample=False):
+
+        num_samples = gpytorch.settings.num_likelihood_samples.value()
+        dist = self(x)
+
+        if sample:
+            # draws of the weights, one per sequence, give draws of functions correlated across
+            # tokens, which the diagonal marginals of dist cannot
+            eps = torch.randn(num_samples, *x.shape[:-2], self.num_features, device=x.device)
+            w = self.variational_mean + F.softplus(self.raw_variational_std) * eps
+            f = self.mean_module(x) + (self.features(x) @ w.unsqueeze(-1)).squeeze(-1)
+            return f, dist
+
+        preds = self.likelihood(dist)
+        mean = preds.mean.expand(num_samples, *preds.mean.shape)
+
+        return mean, dist
+
+    def mll_loss(self, dist, target, num_data):
+        log_likelihood = self.likelihood.expected_log_prob(target, dist).sum(-1).div(dist.event_shape[0])
+        return -(log_likelihood - self.kl_divergence().div(num_data))
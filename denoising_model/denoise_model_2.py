@@ -1,14 +1,27 @@
 import gpytorch
+from gpytorch.distributions import MultivariateNormal
 import torch.nn as nn
 import numpy as np
 import torch
 import random
 from denoising_model.DeepGP import DeepGPp
+from denoising_model.ScalableGP import GridGP, RFFGP
 torch.autograd.set_detect_anomaly(True)
 
+# gp_backend -> GP used to corrupt the inputs, called with (d_model, seed)
+# svgp: deep GP with 256 inducing points over the embeddings
+# kiss: KISS-GP grid interpolation over a learned 1-d projection of the embeddings
+# rff: random Fourier feature GP over the embeddings
+
+gp_backends = {
+    "svgp": DeepGPp,
+    "kiss": GridGP,
+    "rff": RFFGP,
+}
+
 
 class denoise_model_2(nn.Module):
-    def __init__(self, model, model_name, gp, d, device, seed, n_noise=False, residual=False):
+    def __init__(self, model, model_name, gp, d, device, seed, n_noise=False, residual=False, gp_backend="svgp"):
         super(denoise_model_2, self).__init__()
 
         np.random.seed(seed)
@@ -17,8 +30,10 @@ class denoise_model_2(nn.Module):
 
         self.denoising_model = model
 
-        self.deep_gp = DeepGPp(d, seed)
-        # self.proj_up = nn.Linear(1, d)
+        self.deep_gp = gp_backends[gp_backend](d, seed)
+        # only GP runs project the GP noise, so that other runs keep their checkpoints and init
+        if gp:
+            self.proj_up = nn.Linear(1, d)
         self.gp = gp
 
         self.residual = residual
@@ -29,17 +44,30 @@ class denoise_model_2(nn.Module):
         self.n_noise = n_noise
         self.residual = residual
 
-    def add_gp_noise(self, x):
-
-        b, s, _ = x.shape
-
-        eps_gp, dist = self.deep_gp.predict(x)
+    def add_gp_noise(self, enc_inputs, dec_inputs, sample=False):
+        """
+        Corrupts the encoder and decoder inputs with a single deep GP pass over both
+        sequences concatenated along time. The predictive mean is pointwise, so each
+        sequence gets the same noise as in a pass of its own.
+        If sample, the noise is a draw from the GP posterior instead of its mean.
+        Returns the noisy inputs and the GP distribution over the decoder tokens
+        (None in eval mode, where only the predictive mean is computed).
+        """
+        s_enc = enc_inputs.shape[1]
+        x = torch.cat([enc_inputs, dec_inputs], dim=1)
+
+        eps_gp, dist = self.deep_gp.predict(x, sample=sample)
         eps_gp = self.proj_up(eps_gp.permute(1, 2, 0))
         x_noisy = x + eps_gp
 
-        return x_noisy, dist
+        dec_dist = None
+        if dist is not None:
+            dec_dist = MultivariateNormal(dist.mean[..., s_enc:],
+                                          dist.lazy_covariance_matrix[..., s_enc:, s_enc:])
+
+        return x_noisy[:, :s_enc], x_noisy[:, s_enc:], dec_dist
 
-    def forward(self, enc_inputs, dec_inputs):
+    def forward(self, enc_inputs, dec_inputs, sample=False):
 
         eps_enc = torch.randn_like(enc_inputs)
         eps_dec = torch.randn_like(dec_inputs)
@@ -47,8 +75,7 @@ class denoise_model_2(nn.Module):
 
         if self.gp:
 
-            enc_noisy, _ = self.add_gp_noise(enc_inputs)
-            dec_noisy, dist = self.add_gp_noise(dec_inputs)
+            enc_noisy, dec_noisy, dist = self.add_gp_noise(enc_inputs, dec_inputs, sample=sample)
 
         elif self.n_noise:
 
@@ -56,8 +83,11 @@ class denoise_model_2(nn.Module):
             dec_noisy = dec_inputs
 
         else:
-            enc_noisy = enc_inputs.add_(eps_enc * 0.05)
-            dec_noisy = dec_inputs.add_(eps_dec * 0.05)
+            # not in place, so that callers can pass tensors they still use,
+            # the reconstruction is still added to the noisy decoder inputs
+            enc_noisy = enc_inputs + eps_enc * 0.05
+            dec_noisy = dec_inputs + eps_dec * 0.05
+            dec_inputs = dec_noisy
 
         enc_rec, dec_rec = self.denoising_model(enc_noisy, dec_noisy)
 
@@ -9,7 +9,7 @@ import os
 
 from matplotlib import pyplot as plt
 
-from Utils.base_train import batch_sampled_data
+from Utils.sample_cache import cached_batch_sampled_data
 from data_loader import ExperimentConfig
 from forecast_denoising import Forecast_denoising
 
@@ -21,7 +21,10 @@ parser.add_argument("--cuda", type=str, default="cuda:0")
 parser.add_argument("--pred_len", type=int, default=24)
 parser.add_argument("--denoising", type=str, default="False")
 parser.add_argument("--gp", type=str, default="False")
+parser.add_argument("--gp_backend", type=str, default="svgp", choices=["svgp", "kiss", "rff"])
 parser.add_argument("--no-noise", type=str, default="False")
+parser.add_argument("--forecast_only", type=str, default="False",
+                    help="only run the first forecasting pass, skipping the denoiser")
 parser.add_argument("--residual", type=str, default="False")
 parser.add_argument("--iso", type=str, default="False")
 parser.add_argument("--input_corrupt_training", type=str, default="False")
@@ -44,16 +47,14 @@ pred_len = args.pred_len
 
 device = torch.device(args.cuda if torch.cuda.is_available() else "cpu")
 data_csv_path = "{}.csv".format(args.exp_name)
-raw_data = pd.read_csv(data_csv_path)
 
-data = formatter.transform_data(raw_data)
 train_max, valid_max = formatter.get_num_samples_for_calibration(num_train=batch_size)
 max_samples = (train_max, valid_max)
 
-_, _, test = batch_sampled_data(data, 0.8, max_samples, params['total_time_steps'],
-                                        params['num_encoder_steps'], pred_len,
-                                        params["column_definition"],
-                                        batch_size)
+_, _, test = cached_batch_sampled_data(data_csv_path, formatter, 0.8, max_samples,
+                                       params['total_time_steps'], params['num_encoder_steps'], pred_len,
+                                       params["column_definition"],
+                                       batch_size)
 
 test_enc, test_dec, test_y = next(iter(test))
 total_b = len(list(iter(test)))
@@ -79,14 +80,17 @@ no_noise = True if args.no_noise == "True" else False
 residual = True if args.residual == "True" else False
 iso = True if args.iso == "True" else False
 input_corrupt = True if args.input_corrupt_training == "True" else False
+forecast_only = True if args.forecast_only == "True" else False
 
 
 for seed in [8220]:
     for i, m_n in enumerate(["basic", "ATA"]):
         try:
-            model_name = "{}_{}_{}_{}{}{}{}{}{}".format(m_n, args.exp_name, pred_len, seed,
+            model_name = "{}_{}_{}_{}{}{}{}{}{}{}".format(m_n, args.exp_name, pred_len, seed,
                                                         "_denoise" if denoising else "",
                                                         "_gp" if gp else "",
+                                                        "_{}".format(args.gp_backend)
+                                                        if gp and args.gp_backend != "svgp" else "",
                                                         "_predictions" if no_noise else "",
                                                         "_iso" if iso else "",
                                                         "_residual" if residual else "",
@@ -114,7 +118,8 @@ for seed in [8220]:
                                                attn_type=args.attn_type,
                                                no_noise=no_noise,
                                                residual=residual,
-                                               input_corrupt=input_corrupt).to(device)
+                                               input_corrupt=input_corrupt,
+                                               gp_backend=args.gp_backend).to(device)
                     model.to(device)
 
                     checkpoint = torch.load(os.path.join("models_{}_{}".format(args.exp_name, pred_len),
@@ -132,9 +137,11 @@ for seed in [8220]:
                     for test_enc, test_dec, test_y in test:
                         if gp:
                             with gpytorch.settings.num_likelihood_samples(1):
-                                 output, _, _ = model(test_enc.to(device), test_dec.to(device))
+                                 output, _, _ = model(test_enc.to(device), test_dec.to(device),
+                                                      forecast_only=forecast_only)
                         else:
-                            output, _, _ = model(test_enc.to(device), test_dec.to(device))
+                            output, _, _ = model(test_enc.to(device), test_dec.to(device),
+                                                 forecast_only=forecast_only)
 
                         predictions[i, j] = output[:, -pred_len:, :].squeeze(-1).cpu().detach().numpy()
                         if i == 0:
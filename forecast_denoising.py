@@ -1,10 +1,8 @@
 import random
+import gpytorch
 import numpy as np
 import torch
 import torch.nn as nn
-from gpytorch.mlls import DeepApproximateMLL, VariationalELBO
-
-from denoising_model.DeepGP import DeepGPp
 from denoising_model.denoise_model_2 import denoise_model_2
 from forecasting_models.LSTM import RNN
 from modules.transformer import Transformer
@@ -15,7 +13,7 @@ class Forecast_denoising(nn.Module):
     def __init__(self, model_name:str, config: tuple, gp: bool,
                  denoise: bool, device: torch.device,
                  seed: int, pred_len: int, attn_type: str,
-                 no_noise: bool, residual: bool, input_corrupt: bool):
+                 no_noise: bool, residual: bool, input_corrupt: bool, gp_backend: str = "svgp"):
 
         super(Forecast_denoising, self).__init__()
 
@@ -58,15 +56,42 @@ class Forecast_denoising(nn.Module):
                                         model_name, gp,
                                         d_model, device, seed,
                                         n_noise=no_noise,
-                                        residual=residual)
+                                        residual=residual,
+                                        gp_backend=gp_backend)
         self.denoise = denoise
         self.residual = residual
         self.final_projection = nn.Linear(d_model, 1)
         self.enc_embedding = nn.Linear(src_input_size, d_model)
         self.dec_embedding = nn.Linear(tgt_input_size, d_model)
-        self.deep_gp = DeepGPp(d_model, seed)
 
-    def forward(self, enc_inputs, dec_inputs, y_true=None):
+        self._register_load_state_dict_pre_hook(self._drop_unused_gp)
+
+    def _drop_unused_gp(self, state_dict, prefix, *args):
+
+        # checkpoints saved before the unused top-level deep GP was removed still hold its weights
+        for key in [key for key in state_dict if key.startswith('{}deep_gp.'.format(prefix))]:
+            state_dict.pop(key)
+
+    def plan(self, forecast_only=False):
+        """
+        Returns which of the passes after the forecast contribute to the output or the loss,
+        as (denoise, residual).
+        In residual mode the output is the forecast plus a second forecasting pass, so the
+        denoiser only runs where its GP loss is needed, i.e. when training with the GP.
+        With forecast_only, at inference the forecast is returned on its own.
+        """
+        if forecast_only and not self.training:
+            return False, False
+
+        if not (self.denoise or (self.input_corrupt and self.training)):
+            return False, False
+
+        if self.residual:
+            return self.gp and self.training, True
+
+        return True, False
+
+    def forward(self, enc_inputs, dec_inputs, y_true=None, forecast_only=False):
 
         mll_error = 0
         loss = 0
@@ -78,28 +103,75 @@ class Forecast_denoising(nn.Module):
         enc_outputs, dec_outputs = self.forecasting_model(enc_inputs, dec_inputs)
         forecasting_model_outputs = self.final_projection(dec_outputs[:, -self.pred_len:, :])
 
-        if self.denoise or (self.input_corrupt and self.training):
+        run_denoise, run_residual = self.plan(forecast_only)
+        final_outputs = forecasting_model_outputs
+
+        if run_denoise:
 
-            de_model_outputs, dist = self.de_model(enc_outputs.clone(), dec_outputs.clone())
+            de_model_outputs, dist = self.de_model(enc_outputs, dec_outputs)
             final_outputs = self.final_projection(de_model_outputs[:, -self.pred_len:, :])
 
             if self.gp and self.training:
-                mll = DeepApproximateMLL(
-                    VariationalELBO(self.de_model.deep_gp.likelihood, self.de_model.deep_gp, self.d))
-                mll_error = -mll(dist, y_true.permute(2, 0, 1)).mean()
-
-            if self.residual:
-
-                enc_outputs_res, dec_outputs_res = self.forecasting_model(enc_outputs, dec_outputs)
-                res_outputs = self.final_projection(dec_outputs_res[:, -self.pred_len:, :])
-                final_outputs = forecasting_model_outputs + res_outputs
-                if y_true is not None:
-                    residual = y_true - forecasting_model_outputs
-                    loss = nn.MSELoss()(y_true, residual)
-        else:
-            final_outputs = forecasting_model_outputs
+                mll_error = self.de_model.deep_gp.mll_loss(dist, y_true.permute(2, 0, 1), self.d).mean()
+
+        if run_residual:
+
+            enc_outputs_res, dec_outputs_res = self.forecasting_model(enc_outputs, dec_outputs)
+            res_outputs = self.final_projection(dec_outputs_res[:, -self.pred_len:, :])
+            final_outputs = forecasting_model_outputs + res_outputs
+            if y_true is not None:
+                residual = y_true - forecasting_model_outputs
+                loss = nn.MSELoss()(y_true, residual)
 
         if y_true is not None:
             mse_loss = nn.MSELoss()(y_true, final_outputs)
             loss = mse_loss + torch.clip(self.lam, min=0, max=0.005) * mll_error
         return final_outputs, loss, mse_loss
+
+    def predict_samples(self, enc_inputs, dec_inputs, n, quantiles=(0.1, 0.5, 0.9), max_batch_size=4096):
+        """
+        Forecasts with n draws of the GP corruption followed by the denoiser, vectorised by
+        stacking the draws along the batch. The model runs in eval mode, whatever its mode. The forecasting model runs once, its outputs are
+        repeated for as many draws as fit in max_batch_size windows per denoiser pass.
+        Args:
+          enc_inputs, dec_inputs: Encoder and decoder inputs of b windows
+          n: Number of draws
+          quantiles: Quantile levels to return
+          max_batch_size: Maximum number of windows (draws x b) in one denoiser pass
+        Returns:
+          The mean, the quantiles [len(quantiles), b, pred_len, 1] and the std of the draws.
+          The std is zero when the forecast does not depend on the corruption
+          (no denoiser, residual mode or no noise).
+        """
+        b = enc_inputs.shape[0]
+        draws_per_pass = max(1, max_batch_size // b)
+
+        # draws are taken from the inference path, with norms and dropout in eval mode
+        was_training = self.training
+        self.eval()
+
+        try:
+            with torch.no_grad(), gpytorch.settings.num_likelihood_samples(1):
+
+                if not self.plan()[0]:
+                    outputs = self(enc_inputs, dec_inputs)[0]
+                    samples = outputs.unsqueeze(0).expand(n, *outputs.shape)
+
+                else:
+                    enc_outputs, dec_outputs = self.forecasting_model(self.enc_embedding(enc_inputs),
+                                                                      self.dec_embedding(dec_inputs))
+                    samples = []
+                    for start in range(0, n, draws_per_pass):
+                        n_c = min(draws_per_pass, n - start)
+                        # repeat lays the draws out as [n_c * b], draw-major
+                        de_model_outputs, _ = self.de_model(enc_outputs.repeat(n_c, 1, 1),
+                                                            dec_outputs.repeat(n_c, 1, 1),
+                                                            sample=True)
+                        outputs = self.final_projection(de_model_outputs[:, -self.pred_len:, :])
+                        samples.append(outputs.view(n_c, b, *outputs.shape[1:]))
+                    samples = torch.cat(samples)
+        finally:
+            self.train(was_training)
+
+        q = torch.tensor(quantiles, dtype=samples.dtype, device=samples.device)
+        return samples.mean(0), torch.quantile(samples, q, dim=0), samples.std(0)
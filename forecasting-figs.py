@@ -9,7 +9,7 @@ import torch
 import torch.nn as nn
 import os
 
-from Utils.base_train import batch_sampled_data
+from Utils.sample_cache import cached_batch_sampled_data
 from data_loader import ExperimentConfig
 from forecast_denoising import Forecast_denoising
 
@@ -44,16 +44,14 @@ pred_len = args.pred_len
 
 device = torch.device(args.cuda if torch.cuda.is_available() else "cpu")
 data_csv_path = "{}.csv".format(args.exp_name)
-raw_data = pd.read_csv(data_csv_path)
 
-data = formatter.transform_data(raw_data)
 train_max, valid_max = formatter.get_num_samples_for_calibration(num_train=batch_size)
 max_samples = (train_max, valid_max)
 
-_, _, test = batch_sampled_data(data, 0.1, max_samples, params['total_time_steps'],
-                                        params['num_encoder_steps'], pred_len,
-                                        params["column_definition"],
-                                        batch_size)
+_, _, test = cached_batch_sampled_data(data_csv_path, formatter, 0.1, max_samples,
+                                       params['total_time_steps'], params['num_encoder_steps'], pred_len,
+                                       params["column_definition"],
+                                       batch_size)
 
 test_enc, test_dec, test_y = next(iter(test))
 total_b = len(list(iter(test)))
@@ -114,7 +112,7 @@ def get_pred_tgt(denoise, gp, iso, no_noise):
                     model.to(device)
 
                     checkpoint = torch.load(os.path.join("models_{}_{}".format(args.exp_name, pred_len),
-                                                         "{}".format(model_name)))
+                                                         "{}".format(model_name)), map_location=device)
 
                     state_dict = checkpoint['model_state_dict']
 
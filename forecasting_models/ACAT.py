@@ -51,8 +51,15 @@ class ACAT(nn.Module):
 
         attn = torch.softmax(scores, -1)
         attn, _ = torch.max(attn, dim=2)
-        attn_f = torch.zeros(b, h, l, l_k).to(self.device)
-        attn_f[:, :, :, 0::m_f] = attn
-        attn_f = torch.softmax(attn_f, -1)
-        context = torch.einsum('bhqk,bhkd->bhqd', attn_f, V)
+
+        # softmax over all l_k keys of scores equal to attn on the strided keys and 0 on the
+        # others, kept in strided form: every other key has the same weight exp(0) = 1, so
+        # their values only enter through their sum
+        V_s = V[:, :, 0::m_f, :]
+        attn_exp = torch.exp(attn)
+        normaliser = attn_exp.sum(-1, keepdim=True) + (l_k - V_s.shape[2])
+        V_rest = V.sum(dim=2, keepdim=True) - V_s.sum(dim=2, keepdim=True)
+        context = (torch.einsum('bhqk,bhkd->bhqd', attn_exp, V_s) + V_rest) / normaliser
+        # attention weights of the strided keys, [b, h, l, ceil(l_k / m_f)]
+        attn_f = attn_exp / normaliser
         return context, attn_f
\ No newline at end of file
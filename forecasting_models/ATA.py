@@ -1,9 +1,48 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 import random
 
 
+def fuse_conv_stacks(conv_list):
+    """
+    Merges Conv1d+BatchNorm1d+ReLU stacks of odd kernel sizes into one conv whose
+    kernel is as wide as the widest filter (smaller kernels are zero padded to the
+    centre), and one BatchNorm1d over the concatenated output channels.
+    Returns the fused conv, the fused norm and the mask of the real kernel taps.
+    """
+    convs = [stack[0] for stack in conv_list]
+    norms = [stack[1] for stack in conv_list]
+    max_f = max(conv.kernel_size[0] for conv in convs)
+    out_channels = sum(conv.out_channels for conv in convs)
+
+    # weights are copied from the stacks below, skip the random initialisation
+    conv = nn.utils.skip_init(nn.Conv1d, convs[0].in_channels, out_channels, kernel_size=max_f,
+                              padding=(max_f - 1) // 2, device=convs[0].weight.device)
+    norm = nn.BatchNorm1d(out_channels, device=convs[0].weight.device)
+    mask = torch.zeros(out_channels, 1, max_f, device=convs[0].weight.device)
+
+    with torch.no_grad():
+        conv.weight.zero_()
+        start = 0
+        for c, n in zip(convs, norms):
+            end = start + c.out_channels
+            f = c.kernel_size[0]
+            offset = (max_f - f) // 2
+            conv.weight[start:end, :, offset:offset + f] = c.weight
+            conv.bias[start:end] = c.bias
+            mask[start:end, :, offset:offset + f] = 1
+            norm.weight[start:end] = n.weight
+            norm.bias[start:end] = n.bias
+            norm.running_mean[start:end] = n.running_mean
+            norm.running_var[start:end] = n.running_var
+            start = end
+        norm.num_batches_tracked.copy_(norms[0].num_batches_tracked)
+
+    return conv, norm, mask
+
+
 class ATA(nn.Module):
     def __init__(self, d_k, device, h, seed):
 
@@ -16,50 +55,52 @@ class ATA(nn.Module):
         self.d_k = d_k
         self.filter_length = [1, 3, 7, 9]
 
-        self.conv_list_k = nn.ModuleList([
-            nn.Sequential(nn.Conv1d(
-                in_channels=d_k*h, out_channels=d_k*h, kernel_size=f, padding=int((f-1)/2), device=device),
-                          nn.BatchNorm1d(d_k*h, device=device),
-                          nn.ReLU())
-            for f in self.filter_length
-            ])
+        # the per filter stacks are only built so that the fused convolutions start from the
+        # same values as the separate ones (checkpoints saved before ATA's weights were part of
+        # the model are loaded with these values), all filter lengths then run as a single 9-wide conv
+        conv_list_k = self._conv_stacks(d_k*h, device)
+        conv_list_q = self._conv_stacks(d_k*h, device)
 
-        self.conv_list_q = nn.ModuleList([
-            nn.Sequential(
-                nn.Conv1d(in_channels=d_k*h, out_channels=d_k*h, kernel_size=f, padding=int((f-1)/2), device=device),
-                          nn.BatchNorm1d(d_k*h, device=device),
-                          nn.ReLU())
-            for f in self.filter_length]).to(device)
+        self.conv_k, self.norm_k, mask = fuse_conv_stacks(conv_list_k)
+        self.conv_q, self.norm_q, _ = fuse_conv_stacks(conv_list_q)
+        self.register_buffer('kernel_mask', mask, persistent=False)
 
         self.proj_back_q = nn.Linear(d_k*len(self.filter_length), self.d_k, device=device)
         self.proj_back_k = nn.Linear(d_k*len(self.filter_length), self.d_k, device=device)
 
         self.factor = 1
 
-    def forward(self, Q, K, V):
+    def _conv_stacks(self, channels, device):
 
-        b, h, l, d_k = Q.shape
-        l_k = K.shape[2]
-        Q_l = []
-        K_l = []
+        return nn.ModuleList([
+            nn.Sequential(nn.Conv1d(
+                in_channels=channels, out_channels=channels, kernel_size=f, padding=int((f-1)/2), device=device),
+                          nn.BatchNorm1d(channels, device=device),
+                          nn.ReLU())
+            for f in self.filter_length
+            ])
 
-        Q = Q.reshape(b, -1, l)
-        K = K.reshape(b, -1, l_k)
+    def _multi_kernel_conv(self, x, conv, norm):
 
-        [Q_l.append(self.conv_list_q[i](Q)) for i in range(len(self.filter_length))]
-        [K_l.append(self.conv_list_k[i](K)) for i in range(len(self.filter_length))]
+        weight = conv.weight * self.kernel_mask
+        return F.relu(norm(F.conv1d(x, weight, conv.bias, padding=conv.padding)))
 
-        Q_p = torch.cat(Q_l, dim=0).reshape(b, h, l * len(self.filter_length), -1)
-        K_p = torch.cat(K_l, dim=0).reshape(b, h, l_k * len(self.filter_length), -1)
+    def forward(self, Q, K, V):
+
+        b, h, l, d_k = Q.shape
+        l_k = K.shape[2]
+        n_f = len(self.filter_length)
 
-        Q_proj = Q_p.reshape(b, h, l, -1)
-        Q, _ = torch.topk(Q_proj, dim=-1, k=1)
+        Q = self._multi_kernel_conv(Q.reshape(b, -1, l), self.conv_q, self.norm_q)
+        K = self._multi_kernel_conv(K.reshape(b, -1, l_k), self.conv_k, self.norm_k)
 
-        K_proj = K_p.reshape(b, h, l_k, -1)
-        K, _ = torch.topk(K_proj, dim=-1, k=1)
+        # the filter outputs are grouped as if concatenated along the batch dimension
+        # before taking the top-1 over each run of n_f * d_k values
+        Q = Q.view(b, n_f, -1, l).transpose(0, 1).reshape(b, h, l, -1).max(dim=-1, keepdim=True)[0]
+        K = K.view(b, n_f, -1, l_k).transpose(0, 1).reshape(b, h, l_k, -1).max(dim=-1, keepdim=True)[0]
 
         scores = torch.einsum('bhqd,bhkd->bhqk', Q, K) / np.sqrt(self.d_k)
 
         attn = torch.softmax(scores, -1)
         context = torch.einsum('bhqk,bhkd->bhqd', attn, V)
-        return context, attn
\ No newline at end of file
+        return context, attn
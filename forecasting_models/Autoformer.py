@@ -4,6 +4,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import math
+from layers.AutoCorrelation import delay_aggregation
 
 
 class AutoCorrelation(nn.Module):
@@ -32,23 +33,17 @@ class AutoCorrelation(nn.Module):
         SpeedUp version of Autocorrelation (a batch-normalization style design)
         This is for the training phase.
         """
-        head = values.shape[1]
-        channel = values.shape[2]
+        batch = values.shape[0]
         length = values.shape[3]
         # find top k
         top_k = int(self.factor * math.log(length))
         mean_value = torch.mean(torch.mean(corr, dim=1), dim=1)
         index = torch.topk(torch.mean(mean_value, dim=0), top_k, dim=-1)[1]
-        weights = torch.stack([mean_value[:, index[i]] for i in range(top_k)], dim=-1)
+        weights = mean_value[:, index]
         # update corr
         tmp_corr = torch.softmax(weights, dim=-1)
         # aggregation
-        tmp_values = values
-        delays_agg = torch.zeros_like(values).float()
-        for i in range(top_k):
-            pattern = torch.roll(tmp_values, -int(index[i]), -1)
-            delays_agg = delays_agg + pattern * \
-                         (tmp_corr[:, i].unsqueeze(1).unsqueeze(1).unsqueeze(1).repeat(1, head, channel, length))
+        delays_agg = delay_aggregation(values, index.view(1, 1, 1, top_k), tmp_corr.view(batch, 1, 1, top_k))
         return delays_agg
 
     def time_delay_agg_inference(self, values, corr):
@@ -57,11 +52,7 @@ class AutoCorrelation(nn.Module):
         This is for the inference phase.
         """
         batch = values.shape[0]
-        head = values.shape[1]
-        channel = values.shape[2]
         length = values.shape[3]
-        # index init
-        init_index = torch.arange(length).unsqueeze(0).unsqueeze(0).unsqueeze(0).repeat(batch, head, channel, 1).cuda()
         # find top k
         top_k = int(self.factor * math.log(length))
         mean_value = torch.mean(torch.mean(corr, dim=1), dim=1)
@@ -69,37 +60,21 @@ class AutoCorrelation(nn.Module):
         # update corr
         tmp_corr = torch.softmax(weights, dim=-1)
         # aggregation
-        tmp_values = values.repeat(1, 1, 1, 2)
-        delays_agg = torch.zeros_like(values).float()
-        for i in range(top_k):
-            tmp_delay = init_index + delay[:, i].unsqueeze(1).unsqueeze(1).unsqueeze(1).repeat(1, head, channel, length)
-            pattern = torch.gather(tmp_values, dim=-1, index=tmp_delay)
-            delays_agg = delays_agg + pattern * \
-                         (tmp_corr[:, i].unsqueeze(1).unsqueeze(1).unsqueeze(1).repeat(1, head, channel, length))
+        delays_agg = delay_aggregation(values, delay.view(batch, 1, 1, top_k), tmp_corr.view(batch, 1, 1, top_k))
         return delays_agg
 
     def time_delay_agg_full(self, values, corr):
         """
         Standard version of Autocorrelation
         """
-        batch = values.shape[0]
-        head = values.shape[1]
-        channel = values.shape[2]
         length = values.shape[3]
-        # index init
-        init_index = torch.arange(length).unsqueeze(0).unsqueeze(0).unsqueeze(0).repeat(batch, head, channel, 1).cuda()
         # find top k
         top_k = int(self.factor * math.log(length))
         weights, delay = torch.topk(corr, top_k, dim=-1)
         # update corr
         tmp_corr = torch.softmax(weights, dim=-1)
         # aggregation
-        tmp_values = values.repeat(1, 1, 1, 2)
-        delays_agg = torch.zeros_like(values).float()
-        for i in range(top_k):
-            tmp_delay = init_index + delay[..., i].unsqueeze(-1)
-            pattern = torch.gather(tmp_values, dim=-1, index=tmp_delay)
-            delays_agg = delays_agg + pattern * (tmp_corr[..., i].unsqueeze(-1))
+        delays_agg = delay_aggregation(values, delay, tmp_corr)
         return delays_agg
 
     def forward(self, queries, keys, values, attn_mask=None):
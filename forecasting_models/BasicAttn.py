@@ -1,12 +1,40 @@
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import random
 
 
+def _attention_block(Q, K, V):
+
+    if hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(Q, K, V)
+
+    scores = torch.matmul(Q, K.transpose(-2, -1)) / np.sqrt(Q.shape[-1])
+    return torch.matmul(torch.softmax(scores, -1), V)
+
+
+def chunked_attention(Q, K, V, chunk_size):
+    """
+    Softmax attention softmax(Q K^T / sqrt(d_k)) V computed for blocks of chunk_size queries,
+    with torch's scaled_dot_product_attention where available. Each block's scores are
+    recomputed in the backward pass, so that at most [b, h, chunk_size, l_k] scores are held at once.
+    """
+    blocks = []
+    for start in range(0, Q.shape[2], chunk_size):
+        Q_c = Q[:, :, start:start + chunk_size]
+        if torch.is_grad_enabled():
+            blocks.append(checkpoint(_attention_block, Q_c, K, V, use_reentrant=False))
+        else:
+            blocks.append(_attention_block(Q_c, K, V))
+
+    return torch.cat(blocks, dim=2)
+
+
 class BasicAttn(nn.Module):
 
-    def __init__(self, d_k, device, seed):
+    def __init__(self, d_k, device, seed, chunk_size=None):
 
         super(BasicAttn, self).__init__()
 
@@ -16,10 +44,15 @@ class BasicAttn(nn.Module):
 
         self.device = device
         self.d_k = d_k
+        # opt-in memory-efficient attention over blocks of chunk_size queries
+        self.chunk_size = chunk_size
 
     def forward(self, Q, K, V):
 
+        if self.chunk_size is not None:
+            return chunked_attention(Q, K, V, self.chunk_size), None
+
         scores = torch.einsum('bhqd,bhkd->bhqk', Q, K) / np.sqrt(self.d_k)
         attn = torch.softmax(scores, -1)
         context = torch.einsum('bhqk,bhvd->bhqd', attn, V)
-        return context, attn
\ No newline at end of file
+        return context, attn
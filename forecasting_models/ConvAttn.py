@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import random
+from forecasting_models.BasicAttn import chunked_attention
 
 torch.backends.cudnn.benchmark = False
 torch.backends.cudnn.deterministic = True
@@ -9,7 +10,7 @@ torch.backends.cudnn.deterministic = True
 
 class ConvAttn(nn.Module):
 
-    def __init__(self, d_k, h, kernel, device, seed):
+    def __init__(self, d_k, h, kernel, device, seed, chunk_size=None):
 
         super(ConvAttn, self).__init__()
 
@@ -25,6 +26,8 @@ class ConvAttn(nn.Module):
         self.conv_k = nn.Conv1d(in_channels=d_k * h, out_channels=d_k * h,
                                 kernel_size=kernel,
                                 padding=int(kernel / 2), bias=False).to(device)
+        # opt-in memory-efficient attention over blocks of chunk_size queries
+        self.chunk_size = chunk_size
 
     def forward(self, Q, K, V):
 
@@ -34,6 +37,9 @@ class ConvAttn(nn.Module):
         Q = self.conv_q(Q.reshape(b, h*d_k, l))[:, :, :l].reshape(b, h, l, d_k)
         K = self.conv_k(K.reshape(b, h*d_k, l_k))[:, :, :l_k].reshape(b, h, l_k, d_k)
 
+        if self.chunk_size is not None:
+            return chunked_attention(Q, K, V, self.chunk_size), None
+
         scores = torch.einsum('bhqd,bhkd->bhqk', Q, K) / np.sqrt(self.d_k)
         attn = torch.softmax(scores, -1)
         context = torch.einsum('bhqk,bhvd->bhqd', attn, V)
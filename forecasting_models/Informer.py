@@ -23,22 +23,17 @@ class ProbAttention(nn.Module):
         B, H, L_K, E = K.shape
         _, _, L_Q, _ = Q.shape
 
-        # calculate the sampled Q_K
-        K_expand = K.unsqueeze(-3).expand(B, H, L_Q, L_K, E)
-        index_sample = torch.randint(L_K, (L_Q, sample_k))  # real U = U_part(factor*ln(L_k))*L_q
-        K_sample = K_expand[:, :, torch.arange(L_Q).unsqueeze(1), index_sample, :]
-        Q = Q.reshape(B, H, L_Q, -1)
-        K_sample = K_sample.reshape(B, H, -1, E)
-        Q_K_sample = torch.einsum('bhqd, bhkd -> bhqk', Q, K_sample)
+        # calculate the sampled Q_K, each query against its own sample_k random keys
+        index_sample = torch.randint(L_K, (L_Q, sample_k), device=K.device)  # real U = U_part(factor*ln(L_k))*L_q
+        K_sample = K.index_select(2, index_sample.view(-1)).view(B, H, L_Q, sample_k, E)
+        Q_K_sample = torch.einsum('bhqd, bhqkd -> bhqk', Q, K_sample)
 
         # find the Top_k query with sparisty measurement
         M = Q_K_sample.max(-1)[0] - torch.div(Q_K_sample.sum(-1), L_K)
         M_top = M.topk(n_top, sorted=False)[1]
 
         # use the reduced Q to calculate Q_K
-        Q_reduce = Q[torch.arange(B)[:, None, None],
-                   torch.arange(H)[None, :, None],
-                   M_top, :]  # factor*ln(L_q)
+        Q_reduce = torch.gather(Q, 2, M_top.unsqueeze(-1).expand(-1, -1, -1, Q.shape[-1]))  # factor*ln(L_q)
         Q_K = torch.einsum('bhqd, bhkd -> bhqk', Q_reduce, K)  # factor*ln(L_q)*L_k
 
         return Q_K, M_top
@@ -16,6 +16,21 @@ def decor_time(func):
     return func2
 
 
+def delay_aggregation(values, delay, weights):
+    """
+    Weighted sum of values rolled left by each delay, i.e.
+    sum_i weights[..., i] * torch.roll(values, -delay[..., i], -1),
+    computed as one circular cross-correlation in the frequency domain
+    instead of top_k rolled copies of values.
+    values: [B, H, C, L], delay and weights: [B or 1, H or 1, C or 1, top_k]
+    """
+    length = values.shape[-1]
+    kernel = torch.zeros(weights.shape[:-1] + (length,), dtype=values.dtype, device=values.device)
+    kernel = kernel.scatter_add(-1, delay.expand_as(weights), weights.to(values.dtype))
+    agg = torch.fft.rfft(values, dim=-1) * torch.conj(torch.fft.rfft(kernel, dim=-1))
+    return torch.fft.irfft(agg, n=length, dim=-1)
+
+
 class AutoCorrelation(nn.Module):
     """
     AutoCorrelation Mechanism with the following two phases:
@@ -40,23 +55,17 @@ class AutoCorrelation(nn.Module):
         SpeedUp version of Autocorrelation (a batch-normalization style design)
         This is for the training phase.
         """
-        head = values.shape[1]
-        channel = values.shape[2]
+        batch = values.shape[0]
         length = values.shape[3]
         # find top k
         top_k = int(self.factor * math.log(length))
         mean_value = torch.mean(torch.mean(corr, dim=1), dim=1)
         index = torch.topk(torch.mean(mean_value, dim=0), top_k, dim=-1)[1]
-        weights = torch.stack([mean_value[:, index[i]] for i in range(top_k)], dim=-1)
+        weights = mean_value[:, index]
         # update corr
         tmp_corr = torch.softmax(weights, dim=-1)
         # aggregation
-        tmp_values = values
-        delays_agg = torch.zeros_like(values).float()
-        for i in range(top_k):
-            pattern = torch.roll(tmp_values, -int(index[i]), -1)
-            delays_agg = delays_agg + pattern * \
-                         (tmp_corr[:, i].unsqueeze(1).unsqueeze(1).unsqueeze(1).repeat(1, head, channel, length))
+        delays_agg = delay_aggregation(values, index.view(1, 1, 1, top_k), tmp_corr.view(batch, 1, 1, top_k))
         return delays_agg  # size=[B, H, d, S]
 
     def time_delay_agg_inference(self, values, corr):
@@ -65,51 +74,29 @@ class AutoCorrelation(nn.Module):
         This is for the inference phase.
         """
         batch = values.shape[0]
-        head = values.shape[1]
-        channel = values.shape[2]
         length = values.shape[3]
-        # index init
-        init_index = torch.arange(length).unsqueeze(0).unsqueeze(0).unsqueeze(0).repeat(batch, head, channel, 1).cuda()
         # find top k
         top_k = int(self.factor * math.log(length))
         mean_value = torch.mean(torch.mean(corr, dim=1), dim=1)
-        weights = torch.topk(mean_value, top_k, dim=-1)[0]
-        delay = torch.topk(mean_value, top_k, dim=-1)[1]
+        weights, delay = torch.topk(mean_value, top_k, dim=-1)
         # update corr
         tmp_corr = torch.softmax(weights, dim=-1)
         # aggregation
-        tmp_values = values.repeat(1, 1, 1, 2)
-        delays_agg = torch.zeros_like(values).float()
-        for i in range(top_k):
-            tmp_delay = init_index + delay[:, i].unsqueeze(1).unsqueeze(1).unsqueeze(1).repeat(1, head, channel, length)
-            pattern = torch.gather(tmp_values, dim=-1, index=tmp_delay)
-            delays_agg = delays_agg + pattern * \
-                         (tmp_corr[:, i].unsqueeze(1).unsqueeze(1).unsqueeze(1).repeat(1, head, channel, length))
+        delays_agg = delay_aggregation(values, delay.view(batch, 1, 1, top_k), tmp_corr.view(batch, 1, 1, top_k))
         return delays_agg
 
     def time_delay_agg_full(self, values, corr):
         """
         Standard version of Autocorrelation
         """
-        batch = values.shape[0]
-        head = values.shape[1]
-        channel = values.shape[2]
         length = values.shape[3]
-        # index init
-        init_index = torch.arange(length).unsqueeze(0).unsqueeze(0).unsqueeze(0).repeat(batch, head, channel, 1).cuda()
         # find top k
         top_k = int(self.factor * math.log(length))
-        weights = torch.topk(corr, top_k, dim=-1)[0]
-        delay = torch.topk(corr, top_k, dim=-1)[1]
+        weights, delay = torch.topk(corr, top_k, dim=-1)
         # update corr
         tmp_corr = torch.softmax(weights, dim=-1)
         # aggregation
-        tmp_values = values.repeat(1, 1, 1, 2)
-        delays_agg = torch.zeros_like(values).float()
-        for i in range(top_k):
-            tmp_delay = init_index + delay[..., i].unsqueeze(-1)
-            pattern = torch.gather(tmp_values, dim=-1, index=tmp_delay)
-            delays_agg = delays_agg + pattern * (tmp_corr[..., i].unsqueeze(-1))
+        delays_agg = delay_aggregation(values, delay, tmp_corr)
         return delays_agg
 
     def forward(self, queries, keys, values, attn_mask):
@@ -34,12 +34,13 @@ class FourierBlock(nn.Module):
         it does FFT, linear transform, and Inverse FFT.    
         """
         # get modes on frequency domain
-        self.index = get_frequency_modes(seq_len, modes=modes, mode_select_method=mode_select_method)
-        #print('modes={}, index={}'.format(modes, self.index))
+        index = get_frequency_modes(seq_len, modes=modes, mode_select_method=mode_select_method)
+        #print('modes={}, index={}'.format(modes, index))
+        self.register_buffer('index', torch.tensor(index, dtype=torch.long, device=device), persistent=False)
 
         self.scale = (1 / (in_channels * out_channels))
         self.weights1 = nn.Parameter(
-            self.scale * torch.rand(8, in_channels // 8, out_channels // 8, len(self.index), dtype=torch.cfloat,
+            self.scale * torch.rand(8, in_channels // 8, out_channels // 8, len(index), dtype=torch.cfloat,
                                     device=device))
 
     # Complex multiplication
@@ -53,10 +54,11 @@ class FourierBlock(nn.Module):
         x = q.permute(0, 2, 3, 1)
         # Compute Fourier coefficients
         x_ft = torch.fft.rfft(x, dim=-1)
-        # Perform Fourier neural operations
+        # Perform Fourier neural operations on all selected modes at once,
+        # the output of the wi-th selected mode is written to frequency wi
+        modes = len(self.index)
         out_ft = torch.zeros(B, H, E, L // 2 + 1, device=x.device, dtype=torch.cfloat)
-        for wi, i in enumerate(self.index):
-            out_ft[:, :, :, wi] = self.compl_mul1d(x_ft[:, :, :, i], self.weights1[:, :, :, wi])
+        out_ft[:, :, :, :modes] = torch.einsum("bhix,hiox->bhox", x_ft.index_select(-1, self.index), self.weights1)
         # Return to time domain
         x = torch.fft.irfft(out_ft, n=x.size(-1))
         return (x, None)
@@ -75,15 +77,17 @@ class FourierCrossAttention(nn.Module):
         self.in_channels = in_channels
         self.out_channels = out_channels
         # get modes for queries and keys (& values) on frequency domain
-        self.index_q = get_frequency_modes(seq_len_q, modes=modes, mode_select_method=mode_select_method)
-        self.index_kv = get_frequency_modes(seq_len_kv, modes=modes, mode_select_method=mode_select_method)
+        index_q = get_frequency_modes(seq_len_q, modes=modes, mode_select_method=mode_select_method)
+        index_kv = get_frequency_modes(seq_len_kv, modes=modes, mode_select_method=mode_select_method)
+        self.register_buffer('index_q', torch.tensor(index_q, dtype=torch.long), persistent=False)
+        self.register_buffer('index_kv', torch.tensor(index_kv, dtype=torch.long), persistent=False)
 
-        # print('modes_q={}, index_q={}'.format(len(self.index_q), self.index_q))
-        # print('modes_kv={}, index_kv={}'.format(len(self.index_kv), self.index_kv))
+        # print('modes_q={}, index_q={}'.format(len(index_q), index_q))
+        # print('modes_kv={}, index_kv={}'.format(len(index_kv), index_kv))
 
         self.scale = (1 / (in_channels * out_channels))
         self.weights1 = nn.Parameter(
-            self.scale * torch.rand(8, in_channels // 8, out_channels // 8, len(self.index_q), dtype=torch.cfloat))
+            self.scale * torch.rand(8, in_channels // 8, out_channels // 8, len(index_q), dtype=torch.cfloat))
 
     # Complex multiplication
     def compl_mul1d(self, input, weights):
@@ -97,15 +101,9 @@ class FourierCrossAttention(nn.Module):
         xk = k.permute(0, 2, 3, 1)
         xv = v.permute(0, 2, 3, 1)
 
-        # Compute Fourier coefficients
-        xq_ft_ = torch.zeros(B, H, E, len(self.index_q), device=xq.device, dtype=torch.cfloat)
-        xq_ft = torch.fft.rfft(xq, dim=-1)
-        for i, j in enumerate(self.index_q):
-            xq_ft_[:, :, :, i] = xq_ft[:, :, :, j]
-        xk_ft_ = torch.zeros(B, H, E, len(self.index_kv), device=xq.device, dtype=torch.cfloat)
-        xk_ft = torch.fft.rfft(xk, dim=-1)
-        for i, j in enumerate(self.index_kv):
-            xk_ft_[:, :, :, i] = xk_ft[:, :, :, j]
+        # Compute Fourier coefficients of the selected modes
+        xq_ft_ = torch.fft.rfft(xq, dim=-1).index_select(-1, self.index_q)
+        xk_ft_ = torch.fft.rfft(xk, dim=-1).index_select(-1, self.index_kv)
 
         # perform attention mechanism on frequency domain
         xqk_ft = (torch.einsum("bhex,bhey->bhxy", xq_ft_, xk_ft_))
@@ -119,8 +117,7 @@ class FourierCrossAttention(nn.Module):
         xqkv_ft = torch.einsum("bhxy,bhey->bhex", xqk_ft, xk_ft_)
         xqkvw = torch.einsum("bhex,heox->bhox", xqkv_ft, self.weights1)
         out_ft = torch.zeros(B, H, E, L // 2 + 1, device=xq.device, dtype=torch.cfloat)
-        for i, j in enumerate(self.index_q):
-            out_ft[:, :, :, j] = xqkvw[:, :, :, i]
+        out_ft.index_copy_(-1, self.index_q, xqkvw)
         # Return to time domain
         out = torch.fft.irfft(out_ft / self.in_channels / self.out_channels, n=xq.size(-1))
         return (out, None)
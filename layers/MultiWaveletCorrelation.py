@@ -11,8 +11,7 @@ from einops import rearrange, reduce, repeat
 from torch import nn, einsum, diagonal
 from math import log2, ceil
 import pdb
-from layers.utils_fed import LocalMask
-from layers.utils_fed import get_filter
+from layers.utils_fed import get_filter_bank
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -76,16 +75,7 @@ class MultiWaveletCross(nn.Module):
         self.c = c
         self.k = k
         self.L = L
-        H0, H1, G0, G1, PHI0, PHI1 = get_filter(base, k)
-        H0r = H0 @ PHI0
-        G0r = G0 @ PHI0
-        H1r = H1 @ PHI1
-        G1r = G1 @ PHI1
-
-        H0r[np.abs(H0r) < 1e-8] = 0
-        H1r[np.abs(H1r) < 1e-8] = 0
-        G0r[np.abs(G0r) < 1e-8] = 0
-        G1r[np.abs(G1r) < 1e-8] = 0
+        filter_bank = get_filter_bank(base, k)
         self.max_item = 3
 
         self.attn1 = FourierCrossAttentionW(in_channels=in_channels, out_channels=out_channels, seq_len_q=seq_len_q,
@@ -101,15 +91,11 @@ class MultiWaveletCross(nn.Module):
                                             seq_len_kv=seq_len_kv, modes=modes, activation=activation,
                                             mode_select_method=mode_select_method)
         self.T0 = nn.Linear(k, k)
-        self.register_buffer('ec_s', torch.Tensor(
-            np.concatenate((H0.T, H1.T), axis=0)))
-        self.register_buffer('ec_d', torch.Tensor(
-            np.concatenate((G0.T, G1.T), axis=0)))
+        self.register_buffer('ec_s', torch.Tensor(filter_bank['ec_s']))
+        self.register_buffer('ec_d', torch.Tensor(filter_bank['ec_d']))
 
-        self.register_buffer('rc_e', torch.Tensor(
-            np.concatenate((H0r, G0r), axis=0)))
-        self.register_buffer('rc_o', torch.Tensor(
-            np.concatenate((H1r, G1r), axis=0)))
+        self.register_buffer('rc_e', torch.Tensor(filter_bank['rc_e']))
+        self.register_buffer('rc_o', torch.Tensor(filter_bank['rc_o']))
 
         self.Lk = nn.Linear(ich, c * k)
         self.Lq = nn.Linear(ich, c * k)
@@ -141,12 +127,13 @@ class MultiWaveletCross(nn.Module):
 
         ns = math.floor(np.log2(N))
         nl = pow(2, math.ceil(np.log2(N)))
-        extra_q = q[:, 0:nl - N, :, :]
-        extra_k = k[:, 0:nl - N, :, :]
-        extra_v = v[:, 0:nl - N, :, :]
-        q = torch.cat([q, extra_q], 1)
-        k = torch.cat([k, extra_k], 1)
-        v = torch.cat([v, extra_v], 1)
+        if nl > N:
+            extra_q = q[:, 0:nl - N, :, :]
+            extra_k = k[:, 0:nl - N, :, :]
+            extra_v = v[:, 0:nl - N, :, :]
+            q = torch.cat([q, extra_q], 1)
+            k = torch.cat([k, extra_k], 1)
+            v = torch.cat([v, extra_v], 1)
 
         Ud_q = torch.jit.annotate(List[Tuple[Tensor]], [])
         Ud_k = torch.jit.annotate(List[Tuple[Tensor]], [])
@@ -203,10 +190,8 @@ class MultiWaveletCross(nn.Module):
         x_e = torch.matmul(x, self.rc_e)
         x_o = torch.matmul(x, self.rc_o)
 
-        x = torch.zeros(B, N * 2, c, self.k,
-                        device=x.device)
-        x[..., ::2, :, :] = x_e
-        x[..., 1::2, :, :] = x_o
+        # interleave even and odd outputs along N
+        x = torch.stack((x_e, x_o), dim=2).view(B, N * 2, c, self.k)
         return x
 
 
@@ -286,8 +271,8 @@ class sparseKernelFT1d(nn.Module):
         # Multiply relevant Fourier modes
         l = min(self.modes1, N // 2 + 1)
         # l = N//2+1
-        out_ft = torch.zeros(B, c * k, N // 2 + 1, device=x.device, dtype=torch.cfloat)
-        out_ft[:, :, :l] = self.compl_mul1d(x_fft[:, :, :l], self.weights1[:, :, :l])
+        out_ft = self.compl_mul1d(x_fft[:, :, :l], self.weights1[:, :, :l])
+        # irfft zero-pads the modes above l
         x = torch.fft.irfft(out_ft, n=N)
         x = x.permute(0, 2, 1).view(B, N, c, k)
         return x
@@ -305,16 +290,7 @@ class MWT_CZ1d(nn.Module):
 
         self.k = k
         self.L = L
-        H0, H1, G0, G1, PHI0, PHI1 = get_filter(base, k)
-        H0r = H0 @ PHI0
-        G0r = G0 @ PHI0
-        H1r = H1 @ PHI1
-        G1r = G1 @ PHI1
-
-        H0r[np.abs(H0r) < 1e-8] = 0
-        H1r[np.abs(H1r) < 1e-8] = 0
-        G0r[np.abs(G0r) < 1e-8] = 0
-        G1r[np.abs(G1r) < 1e-8] = 0
+        filter_bank = get_filter_bank(base, k)
         self.max_item = 3
 
         self.A = sparseKernelFT1d(k, alpha, c)
@@ -323,22 +299,19 @@ class MWT_CZ1d(nn.Module):
 
         self.T0 = nn.Linear(k, k)
 
-        self.register_buffer('ec_s', torch.Tensor(
-            np.concatenate((H0.T, H1.T), axis=0)))
-        self.register_buffer('ec_d', torch.Tensor(
-            np.concatenate((G0.T, G1.T), axis=0)))
+        self.register_buffer('ec_s', torch.Tensor(filter_bank['ec_s']))
+        self.register_buffer('ec_d', torch.Tensor(filter_bank['ec_d']))
 
-        self.register_buffer('rc_e', torch.Tensor(
-            np.concatenate((H0r, G0r), axis=0)))
-        self.register_buffer('rc_o', torch.Tensor(
-            np.concatenate((H1r, G1r), axis=0)))
+        self.register_buffer('rc_e', torch.Tensor(filter_bank['rc_e']))
+        self.register_buffer('rc_o', torch.Tensor(filter_bank['rc_o']))
 
     def forward(self, x):
         B, N, c, k = x.shape  # (B, N, k)
         ns = math.floor(np.log2(N))
         nl = pow(2, math.ceil(np.log2(N)))
-        extra_x = x[:, 0:nl - N, :, :]
-        x = torch.cat([x, extra_x], 1)
+        if nl > N:
+            extra_x = x[:, 0:nl - N, :, :]
+            x = torch.cat([x, extra_x], 1)
         Ud = torch.jit.annotate(List[Tensor], [])
         Us = torch.jit.annotate(List[Tensor], [])
         #         decompose
@@ -373,8 +346,6 @@ class MWT_CZ1d(nn.Module):
         x_e = torch.matmul(x, self.rc_e)
         x_o = torch.matmul(x, self.rc_o)
 
-        x = torch.zeros(B, N * 2, c, self.k,
-                        device=x.device)
-        x[..., ::2, :, :] = x_e
-        x[..., 1::2, :, :] = x_o
+        # interleave even and odd outputs along N
+        x = torch.stack((x_e, x_o), dim=2).view(B, N * 2, c, self.k)
         return x
\ No newline at end of file
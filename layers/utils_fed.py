@@ -1,11 +1,15 @@
+import os
+
 import torch
 import torch.nn as nn
 
 import numpy as np
-from functools import partial
+from functools import partial, lru_cache
 
 from scipy.special import eval_legendre
-from sympy import Poly, legendre, Symbol, chebyshevt
+
+# filter banks are cached in the repository, whatever the working directory
+default_cache_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'wavelet_filters')
 
 
 def legendreDer(k, x):
@@ -24,6 +28,9 @@ def phi_(phi_c, x, lb=0, ub=1):
 
 
 def get_phi_psi(k, base):
+    # sympy is slow to import and only needed when a filter bank is not cached yet
+    from sympy import Poly, legendre, Symbol, chebyshevt
+
     x = Symbol('x')
     phi_coeff = np.zeros((k, k))
     phi_2x_coeff = np.zeros((k, k))
@@ -140,6 +147,8 @@ def get_filter(base, k):
     if base not in ['legendre', 'chebyshev']:
         raise Exception('Base not supported')
 
+    from sympy import Poly, legendre, Symbol, chebyshevt
+
     x = Symbol('x')
     H0 = np.zeros((k, k))
     H1 = np.zeros((k, k))
@@ -193,6 +202,49 @@ def get_filter(base, k):
     return H0, H1, G0, G1, PHI0, PHI1
 
 
+@lru_cache(maxsize=None)
+def get_filter_bank(base, k, cache_dir=default_cache_dir):
+    """
+    Filters of get_filter together with the decomposition (ec_s, ec_d) and
+    reconstruction (rc_e, rc_o) matrices of the multiwavelet transform.
+    Memoized per (base, k) and saved as an .npz file in cache_dir, so the
+    symbolic derivation runs once per machine. Returned arrays are shared
+    between callers and must not be modified in place.
+    """
+    if base not in ['legendre', 'chebyshev']:
+        raise Exception('Base not supported')
+
+    path = os.path.join(cache_dir, '{}_{}.npz'.format(base, k))
+    if os.path.exists(path):
+        with np.load(path) as f:
+            return {name: f[name] for name in f.files}
+
+    H0, H1, G0, G1, PHI0, PHI1 = get_filter(base, k)
+    H0r = H0 @ PHI0
+    G0r = G0 @ PHI0
+    H1r = H1 @ PHI1
+    G1r = G1 @ PHI1
+
+    H0r[np.abs(H0r) < 1e-8] = 0
+    H1r[np.abs(H1r) < 1e-8] = 0
+    G0r[np.abs(G0r) < 1e-8] = 0
+    G1r[np.abs(G1r) < 1e-8] = 0
+
+    bank = {'H0': H0, 'H1': H1, 'G0': G0, 'G1': G1, 'PHI0': PHI0, 'PHI1': PHI1,
+            'ec_s': np.concatenate((H0.T, H1.T), axis=0),
+            'ec_d': np.concatenate((G0.T, G1.T), axis=0),
+            'rc_e': np.concatenate((H0r, G0r), axis=0),
+            'rc_o': np.concatenate((H1r, G1r), axis=0)}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **bank)
+    os.replace(tmp_path, path)
+
+    return bank
+
+
 def train(model, train_loader, optimizer, epoch, device, verbose=0,
           lossFn=None, lr_schedule=None,
           post_proc=lambda args: args):
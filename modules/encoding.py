@@ -1,20 +1,44 @@
 import torch.nn as nn
 import torch
 
+# (d_hid, device) -> positional encoding table shared by all PositionalEncoding modules
+_position_tables = {}
+
+
+def get_position_table(d_hid, length, device):
+    """Returns the shared [1, n, d_hid] sinusoidal table on device, with n >= length.
+    The table is rebuilt with at least twice its previous length when it is too short."""
+
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        # 'cuda' and 'cuda:<current>' share one table
+        device = torch.device('cuda', torch.cuda.current_device())
+    key = (d_hid, device)
+    P = _position_tables.get(key)
+    if P is not None and P.shape[1] >= length:
+        return P
+
+    max_len = length if P is None else max(length, 2 * P.shape[1])
+    P = torch.zeros((1, max_len, d_hid), device=device)
+    X = torch.arange(max_len, dtype=torch.float32, device=device).reshape(
+        -1, 1) / torch.pow(10000, torch.arange(
+        0, d_hid, 2, dtype=torch.float32, device=device) / d_hid)
+    P[:, :, 0::2] = torch.sin(X)
+    P[:, :, 1::2] = torch.cos(X)
+    _position_tables[key] = P
+    return P
+
 
 class PositionalEncoding(nn.Module):
     """Positional encoding."""
     def __init__(self, d_hid, device, max_len=1000):
 
         super(PositionalEncoding, self).__init__()
-        # Create a long enough `P`
-        self.P = torch.zeros((1, max_len, d_hid)).to(device)
-        X = torch.arange(max_len, dtype=torch.float32).reshape(
-            -1, 1) / torch.pow(10000, torch.arange(
-            0, d_hid, 2, dtype=torch.float32) / d_hid)
-        self.P[:, :, 0::2] = torch.sin(X)
-        self.P[:, :, 1::2] = torch.cos(X)
+        self.d_hid = d_hid
+        # max_len is only the initial length, the table grows with the inputs
+        get_position_table(d_hid, max_len, device)
 
     def forward(self, X):
-        X = X + self.P[:, :X.shape[1], :].to(X.device)
+        P = get_position_table(self.d_hid, X.shape[1], X.device)
+        X = X + P[:, :X.shape[1], :]
         return X
@@ -13,6 +13,43 @@ from layers.AutoCorrelation import AutoCorrelationLayer
 from layers.FourierCorrelation import FourierBlock
 
 
+def _fedformer_attention(d_model, d_k, n_heads, device, seed):
+
+    encoder_self_att = FourierBlock(in_channels=d_model,
+                                    out_channels=d_model,
+                                    seq_len=96,
+                                    modes=8,
+                                    mode_select_method='random',
+                                    device=device)
+    return AutoCorrelationLayer(encoder_self_att, d_model, n_heads, device)
+
+
+# attn_type -> constructor of the attention kernel, called once per MultiHeadAttention
+# the *_chunked variants compute softmax attention without materialising the full score matrix
+
+attention_chunk_size = 256
+
+attention_registry = {
+    "ATA": lambda d_model, d_k, n_heads, device, seed:
+        ATA(d_k=d_k, device=device, h=n_heads, seed=seed),
+    "ACAT": lambda d_model, d_k, n_heads, device, seed:
+        ACAT(d_k=d_k, device=device, h=n_heads, seed=seed),
+    "autoformer": lambda d_model, d_k, n_heads, device, seed:
+        AutoCorrelation(seed=seed),
+    "fedformer": _fedformer_attention,
+    "conv_attn": lambda d_model, d_k, n_heads, device, seed:
+        ConvAttn(d_k=d_k, device=device, seed=seed, kernel=9, h=n_heads),
+    "informer": lambda d_model, d_k, n_heads, device, seed:
+        ProbAttention(mask_flag=False, seed=seed),
+    "conv_attn_chunked": lambda d_model, d_k, n_heads, device, seed:
+        ConvAttn(d_k=d_k, device=device, seed=seed, kernel=9, h=n_heads, chunk_size=attention_chunk_size),
+    "basic": lambda d_model, d_k, n_heads, device, seed:
+        BasicAttn(d_k=d_k, device=device, seed=seed),
+    "basic_chunked": lambda d_model, d_k, n_heads, device, seed:
+        BasicAttn(d_k=d_k, device=device, seed=seed, chunk_size=attention_chunk_size),
+}
+
+
 class MultiHeadAttention(nn.Module):
 
     def __init__(self, d_model, d_k, d_v, n_heads, device, attn_type, seed):
@@ -37,56 +74,72 @@ class MultiHeadAttention(nn.Module):
         self.attn_type = attn_type
         self.seed = seed
 
-    def forward(self, Q, K, V):
+        # unknown attention types fall back to the basic dot-product attention
+        build_attention = attention_registry.get(attn_type, attention_registry["basic"])
+        self.attention = build_attention(d_model, d_k, n_heads, device, seed)
 
-        batch_size = Q.shape[0]
-        q_s = self.WQ(Q).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
-        k_s = self.WK(K).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
-        v_s = self.WV(V).view(batch_size, -1, self.n_heads, self.d_v).transpose(1, 2)
+        # set when loading checkpoints saved before the kernels were built in __init__, whose
+        # kernels were re-created at every call: they ran in training mode, after seeding the
+        # global RNGs and drawing their initial weights, which left these RNG states behind
+        self.register_buffer('legacy_kernel_mode', torch.tensor(False))
+        self._legacy_kernel_mode = False
+        self._legacy_rng_states = (torch.get_rng_state(), np.random.get_state(), random.getstate())
 
-        # ATA forecasting model
+        self._register_load_state_dict_pre_hook(self._fill_attention_state)
 
-        if self.attn_type == "ATA":
-            context, attn = ATA(d_k=self.d_k, device=self.device, h=self.n_heads, seed=self.seed)(
-            Q=q_s, K=k_s, V=v_s)
+    def _fill_attention_state(self, state_dict, prefix, *args):
 
-        elif self.attn_type == "ACAT":
-            context, attn = ACAT(d_k=self.d_k, device=self.device, h=self.n_heads, seed=self.seed)(
-            Q=q_s, K=k_s, V=v_s)
+        if '{}WQ.weight'.format(prefix) not in state_dict:
+            return
 
-        # Autoformer forecasting model
+        flag_key = '{}legacy_kernel_mode'.format(prefix)
+        if flag_key not in state_dict:
+            # checkpoints saved before the kernels were built in __init__ have no attention weights,
+            # those of parameter-free kernels saved before this flag cannot be told apart from them
+            state_dict[flag_key] = torch.tensor(
+                not any(key.startswith('{}attention.'.format(prefix)) for key in state_dict))
 
-        elif self.attn_type == "autoformer":
-            context, attn = AutoCorrelation(seed=self.seed)(q_s.transpose(1, 2),
-                                                            k_s.transpose(1, 2),
-                                                            v_s.transpose(1, 2))
+        # the kernels of legacy checkpoints keep the seeded initial values a fresh kernel has
+        for key, value in self.attention.state_dict().items():
+            state_dict.setdefault('{}attention.{}'.format(prefix, key), value)
 
-        elif self.attn_type == "fedformer":
+        self._legacy_kernel_mode = bool(state_dict[flag_key])
 
-            encoder_self_att = FourierBlock(in_channels=self.d_model,
-                                            out_channels=self.d_model,
-                                            seq_len=96,
-                                            modes=8,
-                                            mode_select_method='random',
-                                            device=self.device)
-            context, attn = AutoCorrelationLayer(encoder_self_att, self.d_model, self.n_heads, self.device)\
-                                (Q, K, V, attn_mask=None)
+    def _enter_legacy_kernel_call(self):
 
+        self.attention.train()
+        torch.manual_seed(self.seed)
+        torch_state, np_state, py_state = self._legacy_rng_states
+        torch.set_rng_state(torch_state)
+        np.random.set_state(np_state)
+        random.setstate(py_state)
 
-        # CNN-trans forecasting model
+    def forward(self, Q, K, V):
 
-        elif self.attn_type == "conv_attn":
-            context, attn = ConvAttn(d_k=self.d_k, device=self.device, seed=self.seed, kernel=9, h=self.n_heads)(
-            Q=q_s, K=k_s, V=v_s)
+        batch_size = Q.shape[0]
+
+        if self._legacy_kernel_mode:
+            self._enter_legacy_kernel_call()
 
-        # Informer forecasting model
+        # FEDformer works on the un-projected inputs with its own projections
 
-        elif self.attn_type == "informer":
-            context, attn = ProbAttention(mask_flag=False, seed=self.seed)(q_s, k_s, v_s)
+        if self.attn_type == "fedformer":
+            context, attn = self.attention(Q, K, V, attn_mask=None)
 
         else:
-            context, attn = BasicAttn(d_k=self.d_k, device=self.device, seed=self.seed)(Q=q_s, K=k_s, V=v_s)
+            q_s = self.WQ(Q).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
+            k_s = self.WK(K).view(batch_size, -1, self.n_heads, self.d_k).transpose(1, 2)
+            v_s = self.WV(V).view(batch_size, -1, self.n_heads, self.d_v).transpose(1, 2)
+
+            # Autoformer expects [B, L, H, E] inputs
+
+            if self.attn_type == "autoformer":
+                context, attn = self.attention(q_s.transpose(1, 2),
+                                               k_s.transpose(1, 2),
+                                               v_s.transpose(1, 2))
+            else:
+                context, attn = self.attention(q_s, k_s, v_s)
 
         context = context.transpose(1, 2).contiguous().view(batch_size, -1, self.n_heads * self.d_v)
         outputs = self.fc(context)
-        return outputs
\ No newline at end of file
+        return outputs
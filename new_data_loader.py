@@ -1,10 +1,9 @@
-import itertools
 import random
 import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import BatchSampler, TensorDataset
-from pytorch_forecasting.data import TimeSeriesDataSet
+from Utils.base_train import WindowDataset, valid_window_starts, create_dataloader
+from Utils.columnar import get_dataset_columns, read_dataset
 from data import traffic, electricity, air_quality, solar, watershed
 
 
@@ -15,7 +14,9 @@ class DataLoader:
                  target_col,
                  max_train_sample,
                  max_test_sample,
-                 batch_size):
+                 batch_size,
+                 num_workers=0,
+                 pin_memory=False):
 
         data_formatter = {"traffic": traffic.TrafficFormatter,
                           "electricity": electricity.ElectricityFormatter,
@@ -28,15 +29,19 @@ class DataLoader:
         self.max_train_sample = max_train_sample
         self.max_test_sample = max_test_sample
         self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
         seed = 1234
         torch.manual_seed(seed)
         random.seed(seed)
         np.random.seed(seed)
 
+        formatter = data_formatter[exp_name](pred_len)
+        self.formatter = formatter
         data_csv_path = "{}.csv".format(exp_name)
-        data = pd.read_csv(data_csv_path, dtype={'date': str})
+        data = read_dataset(data_csv_path, columns=get_dataset_columns(formatter.get_column_definition()))
         data.sort_values(by=["id", "hours_from_start"], inplace=True)
-        data = data_formatter[exp_name](pred_len).transform_data(data)
+        data = formatter.transform_data(data)
 
         total_batches = int(len(data) / self.batch_size)
         train_len = int(total_batches * batch_size * 0.8)
@@ -71,57 +76,26 @@ class DataLoader:
             )
         )
 
-        self.train_dataset = self.get_train_dataset(train_data, self.max_encoder_length, self.pred_len)
-        self.valid_dataset = self.get_valid_dataset(valid_data, self.max_encoder_length, self.pred_len)
-        self.test_dataset = self.get_test_dataset(test_data, self.max_encoder_length, self.pred_len)
-
-        self.train_loader,  self.train_loader2 = self.create_dataloader(train_data, num_samples=max_train_sample)
-        self.valid_loader, self.valid_loader2 = self.create_dataloader(valid_data, num_samples=max_test_sample)
-        self.test_loader, self.test_loader2 = self.create_dataloader(test_data, num_samples=max_test_sample)
-
-    def get_train_dataset(self, train_data, min_encoder_length, min_prediction_length):
-        return self.create_time_series_dataset(train_data, min_encoder_length, min_prediction_length)
-
-    def get_valid_dataset(self, valid_data, min_encoder_length, min_prediction_length):
-        return self.create_time_series_dataset(valid_data, min_encoder_length, min_prediction_length)
-
-    def get_test_dataset(self, test_data, min_encoder_length, min_prediction_length):
-        return self.create_time_series_dataset(test_data, min_encoder_length, min_prediction_length)
-
-    def create_time_series_dataset(self, data, min_encoder_length=1, min_prediction_length=1):
-        return TimeSeriesDataSet(
-            data,
-            group_ids=["group"],
-            target="value",
-            time_idx="time_idx",
-            min_encoder_length=min_encoder_length,
-            max_encoder_length=self.max_encoder_length,
-            min_prediction_length=min_prediction_length,
-            max_prediction_length=self.pred_len,
-            time_varying_unknown_reals=["value"],
-        )
+        self.train_loader = self.create_dataloader(train_data, num_samples=max_train_sample)
+        self.valid_loader = self.create_dataloader(valid_data, num_samples=max_test_sample)
+        self.test_loader = self.create_dataloader(test_data, num_samples=max_test_sample)
 
     def create_dataloader(self, data, num_samples):
-        batch_sampler = BatchSampler(
-            sampler=torch.utils.data.RandomSampler(data, num_samples=num_samples),
-            batch_size=self.batch_size,
-            drop_last=False,
-        )
-        data_loader = self.create_time_series_dataset(data).to_dataloader(batch_sampler=batch_sampler)
-        x_enc_list = []
-        x_dec_list = []
-        y_list = []
-        for x, y in data_loader:
-            x_enc_list.append(x["encoder_target"][:, :-self.pred_len].unsqueeze(-1))
-            x_dec_list.append(x["encoder_target"][:, -self.pred_len:].unsqueeze(-1))
-            y_list.append(y[0].unsqueeze(-1))
-
-        x_enc = torch.stack(list(itertools.chain.from_iterable(x_enc_list)))
-        x_dec = torch.stack(list(itertools.chain.from_iterable(x_dec_list)))
-        y = torch.stack(list(itertools.chain.from_iterable(y_list)))
-
-        tensor_dataset = TensorDataset(x_enc,
-                                       x_dec,
-                                       y)
-
-        return torch.utils.data.DataLoader(tensor_dataset, batch_size=self.batch_size), data_loader
\ No newline at end of file
+        """Samples num_samples windows of max_encoder_length + pred_len steps within single groups.
+        Windows are sliced lazily from the float32 value series, as
+        (encoder target[:-pred_len], encoder target[-pred_len:], decoder target).
+        """
+
+        series = data["value"].to_numpy(dtype=np.float32).reshape(-1, 1)
+        time_steps = self.max_encoder_length + self.pred_len
+
+        starts = valid_window_starts(data["group"].to_numpy(), 0, len(data), time_steps)
+        starts = starts[np.random.choice(len(starts), min(num_samples, len(starts)), replace=False)]
+
+        dataset = WindowDataset(series, starts, time_steps,
+                                num_encoder_steps=self.max_encoder_length - self.pred_len,
+                                pred_len=self.pred_len,
+                                input_size=1)
+
+        return create_dataloader(dataset, batch_size=self.batch_size,
+                                 num_workers=self.num_workers, pin_memory=self.pin_memory)
@@ -12,24 +12,26 @@ import pandas as pd
 import optuna
 from optuna.trial import TrialState
 from data_loader import ExperimentConfig
-from Utils.base_train import batch_sampled_data
+from Utils.sample_cache import cached_batch_sampled_data
+from Utils.parallel_study import run_parallel_study, get_trial_checkpoint_path, \
+    is_duplicate_trial, resolve_best_checkpoint, get_pruner, run_cuda_work
 from modules.opt_model import NoamOpt
 
 torch.autograd.set_detect_anomaly(True)
 
 with gpytorch.settings.num_likelihood_samples(1):
     class Train:
-        def __init__(self, data, args, pred_len, seed):
+        def __init__(self, data_csv_path, args, pred_len, seed):
 
             config = ExperimentConfig(pred_len, args.exp_name)
             self.input_corrupt = args.input_corrupt_training
             self.denoising = args.denoising if not self.input_corrupt else False
             self.gp = args.gp
+            self.gp_backend = args.gp_backend
             self.no_noise = args.no_noise
             self.residual = args.residual
             self.iso = args.iso
-            self.data = data
-            self.len_data = len(data)
+            self.data_csv_path = data_csv_path
             self.formatter = config.make_data_formatter()
             self.params = self.formatter.get_experiment_params()
             self.total_time_steps = self.params['total_time_steps']
@@ -43,47 +45,52 @@ with gpytorch.settings.num_likelihood_samples(1):
                 os.makedirs(self.model_path)
             self.model_params = self.formatter.get_default_model_params()
             self.batch_size = self.model_params['minibatch_size'][0]
+            self.num_workers = args.num_workers if args.num_workers is not None \
+                else self.params['multiprocessing_workers']
             self.attn_type = args.attn_type
             self.criterion = nn.MSELoss()
             self.mae_loss = nn.L1Loss()
             self.num_epochs = args.num_epochs
-            self.model_name = "{}_{}_{}_{}{}{}{}{}{}{}".format(args.model_name, args.exp_name, pred_len, seed,
+            self.model_name = "{}_{}_{}_{}{}{}{}{}{}{}{}".format(args.model_name, args.exp_name, pred_len, seed,
                                                               "_denoise" if self.denoising else "",
                                                               "_gp" if self.gp else "",
+                                                              "_{}".format(self.gp_backend)
+                                                              if self.gp and self.gp_backend != "svgp" else "",
                                                               "_predictions" if self.no_noise else "",
                                                               "_iso" if self.iso else "",
                                                               "_residual" if self.residual else "",
                                                               "_input_corrupt" if self.input_corrupt else "")
             self.likelihood = gpytorch.likelihoods.GaussianLikelihood()
             self.best_val = 1e10
-            self.param_history = []
             self.exp_name = args.exp_name
             self.best_model = nn.Module()
             self.train, self.valid, self.test, self.n_batches = self.split_data()
             self.run_optuna(args)
-            self.evaluate()
+            run_cuda_work(self.evaluate, args.n_jobs)
 
         def split_data(self):
 
-            data = self.formatter.transform_data(self.data)
-
             train_max, valid_max = self.formatter.get_num_samples_for_calibration()
             n_batches = int(train_max / self.batch_size)
             max_samples = (train_max, valid_max)
 
-            train, valid, test = batch_sampled_data(data, 0.8 if not self.exp_name == "exchange" else 0.4,
-                                                    max_samples, self.params['total_time_steps'],
-                                                    self.params['num_encoder_steps'], self.pred_len,
-                                                    self.params["column_definition"],
-                                                    self.batch_size)
+            train, valid, test = cached_batch_sampled_data(self.data_csv_path, self.formatter,
+                                                           0.8 if not self.exp_name == "exchange" else 0.4,
+                                                           max_samples, self.params['total_time_steps'],
+                                                           self.params['num_encoder_steps'], self.pred_len,
+                                                           self.params["column_definition"],
+                                                           self.batch_size,
+                                                           num_workers=self.num_workers,
+                                                           pin_memory=self.device.type == "cuda")
 
             return train, valid, test, n_batches
 
         def run_optuna(self, args):
 
-            study = optuna.create_study(study_name=args.model_name,
-                                        direction="minimize")
-            study.optimize(self.objective, n_trials=args.n_trials, n_jobs=4)
+            study = run_parallel_study(self.objective, self.model_name,
+                                       os.path.join(self.model_path, "{}_optuna.log".format(self.model_name)),
+                                       args.n_trials, args.n_jobs,
+                                       pruner=get_pruner(args.pruner, self.num_epochs))
 
             pruned_trials = study.get_trials(deepcopy=False, states=[TrialState.PRUNED])
             complete_trials = study.get_trials(deepcopy=False, states=[TrialState.COMPLETE])
@@ -102,13 +109,55 @@ with gpytorch.settings.num_likelihood_samples(1):
             for key, value in trial.params.items():
                 print("    {}: {}".format(key, value))
 
-        def objective(self, trial):
+            # trials ran in other processes, evaluate rebuilds the best one from its checkpoint
+            self.best_path = resolve_best_checkpoint(study, self.model_path, self.model_name)
+            self.best_params = trial.params
+            self.best_val = trial.value
+
+            # keep the losses of the best trial under the model name and remove those of the other trials
+            path_t_losses = "losses_lists"
+            for other in study.get_trials(deepcopy=False):
+                for split in ["train", "valid"]:
+                    trial_path = os.path.join(path_t_losses, "{}_trial{}_mse_losses_{}.npy".format(
+                        self.model_name, other.number, split))
+                    if not os.path.exists(trial_path):
+                        continue
+                    if other.number == trial.number:
+                        os.replace(trial_path,
+                                   os.path.join(path_t_losses, "{}_mse_losses_{}.npy".format(self.model_name, split)))
+                    else:
+                        os.remove(trial_path)
+
+        def get_model(self, d_model, stack_size):
 
-            train_enc, train_dec, train_y = next(iter(self.train))
+            train_enc, train_dec, _ = next(iter(self.train))
 
             src_input_size = train_enc.shape[2]
             tgt_input_size = train_dec.shape[2]
 
+            n_heads = self.model_params['num_heads']
+
+            d_k = int(d_model / n_heads)
+
+            assert d_model % d_k == 0
+
+            config = src_input_size, tgt_input_size, d_model, n_heads, d_k, stack_size
+
+            return Forecast_denoising(model_name=self.model_name,
+                                      config=config,
+                                      gp=self.gp,
+                                      denoise=self.denoising,
+                                      device=self.device,
+                                      seed=self.seed,
+                                      pred_len=self.pred_len,
+                                      attn_type=self.attn_type,
+                                      no_noise=self.no_noise,
+                                      residual=self.residual,
+                                      input_corrupt=self.input_corrupt,
+                                      gp_backend=self.gp_backend).to(self.device)
+
+        def objective(self, trial):
+
             if not os.path.exists(self.model_path):
                 os.makedirs(self.model_path)
 
@@ -118,35 +167,16 @@ with gpytorch.settings.num_likelihood_samples(1):
             w_steps = trial.suggest_categorical("w_steps", [4000])
             stack_size = trial.suggest_categorical("stack_size", [1, 3])
 
-            n_heads = self.model_params['num_heads']
-
-            if [d_model, stack_size, w_steps] in self.param_history:
+            if is_duplicate_trial(trial):
                 raise optuna.exceptions.TrialPruned()
-            self.param_history.append([d_model, stack_size, w_steps])
 
-            d_k = int(d_model / n_heads)
-
-            assert d_model % d_k == 0
-
-            config = src_input_size, tgt_input_size, d_model, n_heads, d_k, stack_size
-
-            train_enc, train_dec, _ = next(iter(self.train))
-
-            model = Forecast_denoising(model_name=self.model_name,
-                                       config=config,
-                                       gp=self.gp,
-                                       denoise=self.denoising,
-                                       device=self.device,
-                                       seed=self.seed,
-                                       pred_len=self.pred_len,
-                                       attn_type=self.attn_type,
-                                       no_noise=self.no_noise,
-                                       residual=self.residual,
-                                       input_corrupt=self.input_corrupt).to(self.device)
+            model = self.get_model(d_model, stack_size)
+            trial_name = "{}_trial{}".format(self.model_name, trial.number)
 
             optimizer = NoamOpt(Adam(model.parameters(), lr=0, betas=(0.9, 0.98), eps=1e-9), 2, d_model, w_steps)
 
             val_loss = 1e10
+            epochs_no_improve = 0
             mse_losses_train = []
             mse_losses_valid = []
             for epoch in range(self.num_epochs):
@@ -157,8 +187,9 @@ with gpytorch.settings.num_likelihood_samples(1):
 
                 for train_enc, train_dec, train_y in self.train:
 
-                    output_fore_den, loss, mse_loss_train = model(train_enc.to(self.device), train_dec.to(self.device),
-                                                  train_y.to(self.device))
+                    output_fore_den, loss, mse_loss_train = model(train_enc.to(self.device, non_blocking=True),
+                                                                  train_dec.to(self.device, non_blocking=True),
+                                                                  train_y.to(self.device, non_blocking=True))
                     total_loss += loss.item()
                     total_loss_mse += mse_loss_train.item()
                     mse_losses_train.append(total_loss_mse)
@@ -170,7 +201,9 @@ with gpytorch.settings.num_likelihood_samples(1):
                 test_loss = 0
                 test_loss_mse = 0
                 for valid_enc, valid_dec, valid_y in self.valid:
-                    output, loss, mse_loss_val = model(valid_enc.to(self.device), valid_dec.to(self.device), valid_y.to(self.device))
+                    output, loss, mse_loss_val = model(valid_enc.to(self.device, non_blocking=True),
+                                                       valid_dec.to(self.device, non_blocking=True),
+                                                       valid_y.to(self.device, non_blocking=True))
                     test_loss += loss.item()
                     test_loss_mse += mse_loss_val.item()
                     mse_losses_valid.append(test_loss_mse)
@@ -180,22 +213,31 @@ with gpytorch.settings.num_likelihood_samples(1):
 
                 if test_loss < val_loss:
                     val_loss = test_loss
-                    if val_loss < self.best_val:
-                        self.best_val = val_loss
-                        self.best_model = model
-                        torch.save({'model_state_dict': self.best_model.state_dict()},
-                                   os.path.join(self.model_path, "{}".format(self.model_name)))
+                    epochs_no_improve = 0
+                    torch.save({'model_state_dict': model.state_dict()},
+                               get_trial_checkpoint_path(self.model_path, self.model_name, trial.number))
+                else:
+                    epochs_no_improve += 1
                 path_t_losses = "losses_lists"
-                if not os.path.exists(path_t_losses):
-                    os.makedirs(path_t_losses)
+                os.makedirs(path_t_losses, exist_ok=True)
+
+                np.save(os.path.join(path_t_losses, "{}_mse_losses_train.npy".format(trial_name)), mse_losses_train)
+                np.save(os.path.join(path_t_losses, "{}_mse_losses_valid.npy".format(trial_name)), mse_losses_valid)
+
+                trial.report(test_loss, epoch)
+                if trial.should_prune():
+                    raise optuna.exceptions.TrialPruned()
 
-                np.save(os.path.join(path_t_losses, "{}_mse_losses_train.npy".format(self.model_name)), mse_losses_train)
-                np.save(os.path.join(path_t_losses, "{}_mse_losses_valid.npy".format(self.model_name)), mse_losses_valid)
+                if epochs_no_improve >= self.params['early_stopping_patience']:
+                    print("Early stopping at epoch: {}".format(epoch))
+                    break
 
             return val_loss
 
         def evaluate(self):
 
+            self.best_model = self.get_model(self.best_params["d_model"], self.best_params["stack_size"])
+            self.best_model.load_state_dict(torch.load(self.best_path, map_location=self.device)['model_state_dict'])
             self.best_model.eval()
 
             _, _, test_y = next(iter(self.test))
@@ -207,7 +249,8 @@ with gpytorch.settings.num_likelihood_samples(1):
             j = 0
 
             for test_enc, test_dec, test_y in self.test:
-                output, _, _ = self.best_model(test_enc.to(self.device), test_dec.to(self.device))
+                output, _, _ = self.best_model(test_enc.to(self.device, non_blocking=True),
+                                               test_dec.to(self.device, non_blocking=True))
                 predictions[j] = output.squeeze(-1).cpu().detach()
                 test_y_tot[j] = test_y[:, -self.pred_len:, :].squeeze(-1).cpu().detach()
                 j += 1
@@ -253,18 +296,24 @@ with gpytorch.settings.num_likelihood_samples(1):
         parser.add_argument("--cuda", type=str, default="cuda:0")
         parser.add_argument("--seed", type=int, default=1234)
         parser.add_argument("--n_trials", type=int, default=5)
+        parser.add_argument("--n_jobs", type=int, default=4, help="Optuna trials run in parallel processes")
+        parser.add_argument("--pruner", type=str, default="median",
+                            choices=["median", "hyperband", "successive_halving", "none"])
         parser.add_argument("--denoising", type=lambda x: str(x).lower() == "true", default="True")
         parser.add_argument("--gp", type=lambda x: str(x).lower() == "true", default="True")
+        parser.add_argument("--gp_backend", type=str, default="svgp", choices=["svgp", "kiss", "rff"],
+                            help="GP used to corrupt the inputs when --gp is True")
         parser.add_argument("--residual", type=lambda x: str(x).lower() == "true", default="False")
         parser.add_argument("--no-noise", type=lambda x: str(x).lower() == "true", default="False")
         parser.add_argument("--input_corrupt_training", type=lambda x: str(x).lower() == "true", default="False")
         parser.add_argument("--iso", type=lambda x: str(x).lower() == "true", default="False")
         parser.add_argument("--num_epochs", type=int, default=50)
+        parser.add_argument("--num_workers", type=int, default=None,
+                            help="DataLoader worker processes, defaults to the formatter's multiprocessing_workers")
 
         args = parser.parse_args()
 
         data_csv_path = "{}.csv".format(args.exp_name)
-        raw_data = pd.read_csv(data_csv_path, dtype={'date': str})
 
         random.seed(1234)
 
@@ -274,7 +323,7 @@ with gpytorch.settings.num_likelihood_samples(1):
             random.seed(seed)
             torch.manual_seed(seed)
             for pred_len in [96]:
-                Train(raw_data, args, pred_len, seed)
+                Train(data_csv_path, args, pred_len, seed)
 
     if __name__ == '__main__':
         main()